@@ -0,0 +1,245 @@
+#!env python3
+
+# Generates a synthetic PreTeXt-style html build directory for benchmarking
+# pretex.py: section pages and knowls containing inline and displayed math,
+# tagged equations, LaTeX code, bare code, and figures.
+#
+# The output only depends on the options (including --seed), so runs with the
+# same options are comparable.
+
+import argparse
+import os
+import random
+import struct
+import zlib
+
+
+PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html lang="en-US">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style id="pretex-style"></style>
+<style id="pretex-fonts"></style>
+</head>
+<body class="mathbook-book">
+<header id="masthead"><h1 class="heading">{title}</h1></header>
+<main class="main"><div id="content" class="mathbook-content">
+<section class="section" id="{ident}">
+{body}
+</section>
+</div></main>
+</body>
+</html>
+'''
+
+KNOWL_TEMPLATE = '''<!DOCTYPE html>
+<html lang="en-US">
+<head><meta charset="utf-8"><style id="pretex-style"></style>
+<style id="pretex-fonts"></style></head>
+<body>
+<article class="definition-like" id="{ident}">
+{body}
+</article>
+</body>
+</html>
+'''
+
+PREAMBLE = r'''
+\newcommand{\R}{\mathbb{R}}
+\renewcommand{\vec}[1]{\mathbf{#1}}
+'''
+
+WORDS = '''the matrix vector space linear map is a of an with for every column
+row span basis kernel image such that then we have if and only eigenvalue
+consider suppose let by definition theorem it follows equation solution
+system rank dimension subspace'''.split()
+
+INLINE = [
+    r'x', r'A', r'\R^{{{n}}}', r'x_{{{n}}}', r'A\vec x = \vec b',
+    r'\lambda_{{{n}}}', r'\det(A - \lambda I_{{{n}}})', r'T\colon\R^n\to\R^m',
+    r'\frac{{{n}}}{{{m}}}', r'\sqrt{{{n}}}', r'\operatorname{{rank}}(A)',
+    r'e^{{{n}x}}', r'\sum_{{i=1}}^{{{n}}} a_i',
+    r'\{{\vec v_1,\ldots,\vec v_{{{n}}}\}}',
+]
+
+# Displayed code contains its own math environment; a \tag may be appended
+DISPLAY = [
+    r'\begin{{equation*}}A = \begin{{pmatrix}} {n} & {m} \\ {m} & {n} '
+    r'\end{{pmatrix}}{tag}\end{{equation*}}',
+    r'\begin{{equation*}}\int_0^{{{n}}} x^{{{m}}}\,dx '
+    r'= \frac{{{n}^{{{m}+1}}}}{{{m}+1}}{tag}\end{{equation*}}',
+    r'\begin{{align*}} x_1 + {n}x_2 &= {m} \\ {m}x_1 - x_2 &= {n}{tag} '
+    r'\end{{align*}}',
+    r'\begin{{equation*}}\det\begin{{pmatrix}} a & b \\ c & d '
+    r'\end{{pmatrix}} = ad - bc{tag}\end{{equation*}}',
+    r'\begin{{equation*}}\vec x = \sum_{{k=1}}^{{{n}}} c_k \vec v_k{tag}'
+    r'\end{{equation*}}',
+]
+
+CODE = [
+    r'\begin{{tabular}}{{c|c}} $x$ & ${n}$ \\ \hline $y$ & ${m}$ '
+    r'\end{{tabular}}',
+    r'\[ \begin{{bmatrix}} 1 & {n} \\ 0 & {m} \end{{bmatrix}} \]',
+]
+
+CODE_BARE = [
+    r'\def\benchvalue{{{n}{m}}}',
+]
+
+
+def png(width, height, seed):
+    "A small grayscale png image."
+    rows = b''
+    for y in range(height):
+        rows += b'\0' + bytes((x * y + seed) % 256 for x in range(width))
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0,
+                                         0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows))
+            + chunk(b'IEND', b''))
+
+class Corpus:
+    "Generates the pages of one corpus."
+
+    def __init__(self, options):
+        self.options = options
+        self.rand = random.Random(options.seed)
+        self.snippets = []
+        self.num_snippets = 0
+        self.num_figures = 0
+
+    def _code(self, templates, tag=''):
+        self.num_snippets += 1
+        # A fraction of equations repeat earlier ones, as in real books
+        if not tag and self.snippets \
+           and self.rand.random() < self.options.duplicates:
+            return self.rand.choice(self.snippets)
+        code = self.rand.choice(templates).format(
+            n=self.rand.randint(2, 99), m=self.rand.randint(2, 99), tag=tag)
+        self.snippets.append(code)
+        return code
+
+    def _words(self, num):
+        return ' '.join(self.rand.choice(WORDS) for _ in range(num))
+
+    @staticmethod
+    def _script(typ, code):
+        return '<script type="text/x-latex-{}">{}</script>'.format(typ, code)
+
+    def body(self, counts, ident):
+        opts = self.options
+        parts = []
+        for _ in range(counts['inline']):
+            # Sometimes the equation is followed by punctuation or a suffix,
+            # which exercises the binding wrapper
+            parts.append('<p>{} {}{} {}.</p>'.format(
+                self._words(8), self._script('inline', self._code(INLINE)),
+                self.rand.choice(['', ',', 'th', '']), self._words(5)))
+        for i in range(counts['display']):
+            tag = ''
+            if self.rand.random() < opts.tagged:
+                tag = r'\tag{{{}.{}}}'.format(ident, i + 1)
+            parts.append(self._script('display', self._code(DISPLAY, tag)))
+        for _ in range(counts['code']):
+            parts.append(self._script('code', self._code(CODE)))
+        for _ in range(counts['code_bare']):
+            parts.append(self._script('code-bare', self._code(CODE_BARE)))
+        for _ in range(counts['figures']):
+            self.num_figures += 1
+            parts.append('<figure class="figure">{}</figure>'.format(
+                self._script('code', r'\includegraphics[width=2in]{{{}}}'
+                             .format('bench{}'.format(self.num_figures)))))
+        self.rand.shuffle(parts)
+        return '\n'.join(parts)
+
+    def write(self, out_dir):
+        opts = self.options
+        os.makedirs(os.path.join(out_dir, 'knowl'), exist_ok=True)
+        page_counts = {
+            'inline'    : opts.inline,
+            'display'   : opts.display,
+            'code'      : opts.code,
+            'code_bare' : opts.code_bare,
+            'figures'   : opts.figures,
+        }
+        for num in range(opts.pages):
+            ident = 'section-{}'.format(num + 1)
+            with open(os.path.join(out_dir, ident + '.html'), 'w') as fobj:
+                fobj.write(PAGE_TEMPLATE.format(
+                    title='Section {}'.format(num + 1), ident=ident,
+                    body=self.body(page_counts, str(num + 1))))
+        # Knowls are small
+        knowl_counts = {key : (val + 9) // 10
+                        for key, val in page_counts.items()}
+        knowl_counts['figures'] = 0
+        for num in range(opts.knowls):
+            ident = 'knowl-{}'.format(num + 1)
+            with open(os.path.join(out_dir, 'knowl', ident + '.html'),
+                      'w') as fobj:
+                fobj.write(KNOWL_TEMPLATE.format(
+                    ident=ident, body=self.body(knowl_counts, ident)))
+
+        img_dir = os.path.join(out_dir, 'figure-images')
+        os.makedirs(img_dir, exist_ok=True)
+        for num in range(self.num_figures):
+            with open(os.path.join(img_dir, 'bench{}.png'.format(num + 1)),
+                      'wb') as fobj:
+                fobj.write(png(64, 48, num))
+        with open(os.path.join(out_dir, 'preamble.tex'), 'w') as fobj:
+            fobj.write(PREAMBLE)
+
+    def summary(self):
+        return {
+            'snippets' : self.num_snippets,
+            'unique'   : len(set(self.snippets)),
+            'figures'  : self.num_figures,
+        }
+
+
+def add_arguments(parser):
+    parser.add_argument('--pages', type=int, default=20,
+                        help='Number of section pages')
+    parser.add_argument('--knowls', type=int, default=40,
+                        help='Number of knowl files')
+    parser.add_argument('--inline', type=int, default=60,
+                        help='Inline equations per page')
+    parser.add_argument('--display', type=int, default=15,
+                        help='Displayed equations per page')
+    parser.add_argument('--tagged', type=float, default=0.3,
+                        help='Fraction of displayed equations with a \\tag')
+    parser.add_argument('--code', type=int, default=3,
+                        help='LaTeX code blocks per page')
+    parser.add_argument('--code-bare', type=int, default=1,
+                        help='Bare LaTeX code blocks per page')
+    parser.add_argument('--figures', type=int, default=1,
+                        help='Figures (included images) per page')
+    parser.add_argument('--duplicates', type=float, default=0.2,
+                        help='Fraction of snippets repeating earlier ones')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed')
+
+def generate(options, out_dir):
+    "Write a corpus to out_dir; return a summary of its contents."
+    corpus = Corpus(options)
+    corpus.write(out_dir)
+    return corpus.summary()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic html corpus for benchmarks.')
+    add_arguments(parser)
+    parser.add_argument('out_dir', type=str,
+                        help='Build directory to create')
+    args = parser.parse_args()
+    summary = generate(args, args.out_dir)
+    print("Wrote {pages} pages and {knowls} knowls to {out}".format(
+        pages=args.pages, knowls=args.knowls, out=args.out_dir))
+    print("{snippets} snippets ({unique} unique), {figures} figures".format(
+        **summary))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!env python3
+
+# Replays the python stages of processtex on files saved by
+# "pretex.py --record DIR" (or "processtex.py --record DIR"), without running
+# LaTeX, FontForge or Inkscape.  Each recorded html file is processed from
+# scratch in every round, and the time spent in each stage is summarized over
+# the rounds.
+#
+# With --compare, exits with an error if the median time of any stage
+# regressed by more than --max-regression percent.
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+from tempfile import TemporaryDirectory
+
+BASE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(BASE, '..'))
+
+import processtex
+import stats
+
+
+# Recorded stages, in pipeline order
+STAGES = ('parse', 'extract', 'read_extents', 'process_svgs', 'write_html')
+
+
+def replay_doc(rec_dir, tmpdir):
+    "Run the python stages on one recording; returns the Stats."
+    processtex.STATS = stats.Stats()
+    with open(os.path.join(rec_dir, 'meta.json')) as fobj:
+        meta = json.load(fobj)
+    work_dir = os.path.join(tmpdir, os.path.basename(rec_dir))
+    img_dir = os.path.join(work_dir, 'figure-images')
+    cache_dir = os.path.join(work_dir, 'cache')
+    for path in (img_dir, cache_dir):
+        os.makedirs(path)
+    html_file = os.path.join(work_dir, meta['html_file'])
+    shutil.copy(os.path.join(rec_dir, 'input.html'), html_file)
+
+    with processtex.STATS.stage('parse'):
+        doc = processtex.HTMLDoc(html_file, meta['preamble'], work_dir,
+                                 cache_dir, img_dir, **meta['options'])
+    with processtex.STATS.stage('extract'):
+        doc.make_latex()
+    # Put the recorded output of the external tools in place
+    doc.make_dirs()
+    shutil.copy(os.path.join(rec_dir, 'boxsize.txt'), doc.boxsize_file)
+    shutil.rmtree(doc.svg_dir)
+    shutil.copytree(os.path.join(rec_dir, 'svg'), doc.svg_dir)
+    os.makedirs(doc.out_img_dir, exist_ok=True)
+    for fname in os.listdir(os.path.join(rec_dir, 'img')):
+        shutil.copy(os.path.join(rec_dir, 'img', fname), doc.out_img_dir)
+    for name, font_hash in meta['fonts'].items():
+        with open(os.path.join(rec_dir, 'fonts', font_hash), 'rb') as fobj:
+            doc.add_font(name, fobj.read(), font_hash)
+
+    with processtex.STATS.stage('read_extents'):
+        doc.read_extents()
+    doc.write_html(html_file)
+    return processtex.STATS
+
+def summarize(samples):
+    return {
+        'min'    : min(samples),
+        'median' : statistics.median(samples),
+        'mean'   : statistics.mean(samples),
+        'stddev' : statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        'rounds' : len(samples),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the python stages of processtex on recorded files.')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Number of times to process each recording')
+    parser.add_argument('--output', type=str, default='',
+                        help='Write timings to this json file')
+    parser.add_argument('--compare', type=str, default='',
+                        help='Compare with timings in this json file')
+    parser.add_argument('--max-regression', type=float, default=10,
+                        help='Allowed slowdown of a median, in percent')
+    parser.add_argument('record_dir', type=str,
+                        help='Directory passed to --record')
+    args = parser.parse_args()
+
+    recordings = sorted(
+        os.path.join(args.record_dir, name)
+        for name in os.listdir(args.record_dir)
+        if os.path.exists(os.path.join(args.record_dir, name, 'meta.json')))
+    if not recordings:
+        print("No recordings found in {}".format(args.record_dir))
+        sys.exit(1)
+
+    # Total time of each stage over all recordings, for each round
+    samples = {stage : [] for stage in STAGES + ('total',)}
+    for _ in range(args.rounds):
+        totals = {stage : 0.0 for stage in samples}
+        with TemporaryDirectory() as tmpdir:
+            for rec_dir in recordings:
+                for name, entry in replay_doc(rec_dir, tmpdir).stages.items():
+                    totals[name] += entry['wall']
+                    totals['total'] += entry['wall']
+        for stage, total in totals.items():
+            samples[stage].append(total)
+    results = {stage : summarize(vals) for stage, vals in samples.items()}
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fobj:
+            previous = json.load(fobj)['stages']
+    print("{} recordings, {} rounds".format(len(recordings), args.rounds))
+    print("{:14s} {:>10s} {:>10s} {:>10s} {:>10s}".format(
+        'stage', 'min', 'median', 'mean', 'stddev'))
+    regressed = []
+    for stage in STAGES + ('total',):
+        result = results[stage]
+        line = "{:14s} {:9.4f}s {:9.4f}s {:9.4f}s {:9.4f}s".format(
+            stage, result['min'], result['median'], result['mean'],
+            result['stddev'])
+        if previous and previous.get(stage, {}).get('median'):
+            change = 100 * (result['median'] / previous[stage]['median'] - 1)
+            line += " {:+6.1f}%".format(change)
+            if change > args.max_regression:
+                regressed.append(stage)
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as fobj:
+            json.dump({'recordings' : len(recordings), 'stages' : results},
+                      fobj, indent=1, sort_keys=True)
+    if regressed:
+        print("Regressed: {}".format(', '.join(regressed)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!env python3
+
+# Benchmarks the full pretex.py pipeline on a generated corpus.
+#
+# The corpus is processed twice: "cold", with an empty cache, and "warm", on
+# freshly generated html with the cache from the cold run.  Both runs report
+# files/sec, equations/sec, time per stage and output bytes.  The results are
+# written as json, and can be compared with a previous result file.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+import gen_corpus
+
+
+BASE = os.path.dirname(os.path.realpath(__file__))
+PRETEX = os.path.join(BASE, '..', 'pretex.py')
+
+
+def dir_size(path):
+    total = 0
+    for dirpath, _, fnames in os.walk(path):
+        for fname in fnames:
+            total += os.path.getsize(os.path.join(dirpath, fname))
+    return total
+
+def html_size(build_dir):
+    total = 0
+    for dirpath in (build_dir, os.path.join(build_dir, 'knowl')):
+        for fname in os.listdir(dirpath):
+            if fname.endswith('.html'):
+                total += os.path.getsize(os.path.join(dirpath, fname))
+    return total
+
+def run_pretex(build_dir, cache_dir, stats_file, extra_args):
+    "Run pretex.py on a corpus; return a summary of the run."
+    cmdline = [
+        sys.executable, PRETEX,
+        '--build-dir', build_dir,
+        '--preamble', os.path.join(build_dir, 'preamble.tex'),
+        '--img-dir', os.path.join(build_dir, 'figure-images'),
+        '--cache-dir', cache_dir,
+        '--stats', stats_file,
+    ] + extra_args
+    start = time.time()
+    subprocess.run(cmdline, check=True, stdout=subprocess.DEVNULL)
+    wall = time.time() - start
+    with open(stats_file) as fobj:
+        report = json.load(fobj)
+    counts = report['counts']
+    return {
+        'wall'              : wall,
+        'files'             : counts.get('files', 0),
+        'equations'         : counts.get('equations', 0),
+        'files_per_sec'     : counts.get('files', 0) / wall,
+        'equations_per_sec' : counts.get('equations', 0) / wall,
+        'cache_hits'        : counts.get('cache_hits', 0),
+        'cache_misses'      : counts.get('cache_misses', 0),
+        'stages'            : {name : entry['wall']
+                               for name, entry in report['stages'].items()},
+        'html_bytes'        : html_size(build_dir),
+        'cache_bytes'       : dir_size(cache_dir),
+    }
+
+def print_result(phase, result, previous=None):
+    def change(key, val, prev):
+        if prev is None or not prev.get(key):
+            return ''
+        return ' ({:+.1f}%)'.format(100 * (val - prev[key]) / prev[key])
+    print("{}:".format(phase))
+    for key in ('wall', 'files_per_sec', 'equations_per_sec', 'html_bytes',
+                'cache_bytes', 'cache_hits', 'cache_misses'):
+        val = result[key]
+        fmt = '{:.2f}' if isinstance(val, float) else '{}'
+        print("  {:20s} {}{}".format(
+            key, fmt.format(val), change(key, val, previous)))
+    prev_stages = previous['stages'] if previous else None
+    for name, wall in sorted(result['stages'].items(),
+                             key=lambda item: -item[1]):
+        print("  stage {:14s} {:.2f}s{}".format(
+            name, wall, change(name, wall, prev_stages)))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark pretex.py on a generated corpus.')
+    gen_corpus.add_arguments(parser)
+    parser.add_argument('--work-dir', type=str, default='',
+                        help='Keep the corpus and cache here '
+                        '(default: a temporary directory)')
+    parser.add_argument('--output', type=str, default='',
+                        help='Write results to this json file')
+    parser.add_argument('--compare', type=str, default='',
+                        help='Compare with results in this json file')
+    parser.add_argument('pretex_args', nargs=argparse.REMAINDER,
+                        help='Extra arguments for pretex.py (after --)')
+    args = parser.parse_args()
+    extra_args = [arg for arg in args.pretex_args if arg != '--']
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fobj:
+            previous = json.load(fobj)
+
+    with TemporaryDirectory() as tmpdir:
+        work_dir = args.work_dir or tmpdir
+        build_dir = os.path.join(work_dir, 'build')
+        cache_dir = os.path.join(work_dir, 'cache')
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        results = {}
+        for phase in ('cold', 'warm'):
+            # pretex.py rewrites the html in place
+            shutil.rmtree(build_dir, ignore_errors=True)
+            corpus = gen_corpus.generate(args, build_dir)
+            results[phase] = run_pretex(
+                build_dir, cache_dir,
+                os.path.join(work_dir, phase + '-stats.json'), extra_args)
+            print_result(phase, results[phase],
+                         previous['results'][phase] if previous else None)
+
+    output = {
+        'corpus'      : dict(corpus, **{
+            key : getattr(args, key)
+            for key in ('pages', 'knowls', 'inline', 'display', 'tagged',
+                        'code', 'code_bare', 'figures', 'duplicates', 'seed')
+        }),
+        'pretex_args' : extra_args,
+        'results'     : results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fobj:
+            json.dump(output, fobj, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
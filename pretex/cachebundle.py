@@ -0,0 +1,176 @@
+#!env python3
+
+# Cache bundles, for starting the cache of a new machine from another one.
+#
+#     cachebundle.py export --cache-dir pretex-cache -o cache.tar.xz build/
+#     cachebundle.py import --cache-dir pretex-cache cache.tar.xz
+#
+# Export writes the cache entries that the pages of a build use to a single
+# xz-compressed tar file: the rendered math of each page (found by the
+# "pretex cache" comment processtex writes in the page) and the images and
+# external svgs in figure-images/.  Stale entries of older builds and the
+# checkpoints of interrupted builds are left out, and an entry used by several
+# pages is only written once.
+#
+# The bundle starts with a manifest of the sha256 of each entry.  Import
+# checks each entry against it, and adds the entries that are not in the
+# cache yet.  Entries that don't match the manifest are not imported.
+
+import argparse
+import json
+import os
+import re
+import sys
+import tarfile
+import time
+from hashlib import sha256
+from io import BytesIO
+
+
+MANIFEST = 'manifest.json'
+
+# As written by HTMLDoc._write_html() in processtex
+CACHE_COMMENT_RE = re.compile(r'/\* pretex cache: ([-\w]+) \*/')
+IMAGE_RE = re.compile(r'figure-images/([-\w]+\.(?:png|svg))')
+# A page entry: the hash, and a suffix for the output options
+ENTRY_RE = re.compile(r'([-\w]{20})(?:-[sx2g]+)?$')
+
+
+def html_files(build_dir):
+    for dirpath in (build_dir, os.path.join(build_dir, 'knowl')):
+        if not os.path.isdir(dirpath):
+            continue
+        for fname in sorted(os.listdir(dirpath)):
+            if fname.endswith('.html'):
+                yield os.path.join(dirpath, fname)
+
+def referenced_entries(cache_dir, build_dirs):
+    "Names of the cache entries used by the pages in build_dirs."
+    hashes = set()
+    images = set()
+    for build_dir in build_dirs:
+        for html_file in html_files(build_dir):
+            with open(html_file, encoding='utf-8') as fobj:
+                text = fobj.read()
+            hashes.update(CACHE_COMMENT_RE.findall(text))
+            images.update(IMAGE_RE.findall(text))
+    names = set()
+    for fname in os.listdir(cache_dir):
+        # Not the checkpoints of interrupted builds, in checkpoints/
+        if not os.path.isfile(os.path.join(cache_dir, fname)):
+            continue
+        match = ENTRY_RE.match(fname)
+        if match and match.group(1) in hashes:
+            names.add(fname)
+    # Cached pages can refer to images too
+    for name in list(names):
+        with open(os.path.join(cache_dir, name), encoding='utf-8') as fobj:
+            images.update(IMAGE_RE.findall(fobj.read()))
+    names.update(name for name in images
+                 if os.path.exists(os.path.join(cache_dir, name)))
+    return sorted(names)
+
+def file_sha256(fname):
+    digest = sha256()
+    with open(fname, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def export_bundle(cache_dir, names, out_file):
+    "Write the entries to out_file.  Returns the number of bytes written."
+    entries = {}
+    for name in names:
+        fname = os.path.join(cache_dir, name)
+        entries[name] = {'sha256' : file_sha256(fname),
+                         'size'   : os.path.getsize(fname)}
+    manifest = json.dumps({
+        'created' : time.time(),
+        'entries' : entries,
+    }, indent=1, sort_keys=True).encode()
+    with tarfile.open(out_file, 'w:xz') as tar:
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(manifest)
+        info.mtime = time.time()
+        tar.addfile(info, BytesIO(manifest))
+        for name in names:
+            tar.add(os.path.join(cache_dir, name), arcname=name,
+                    recursive=False)
+    return os.path.getsize(out_file)
+
+def import_bundle(fobj, cache_dir):
+    """
+    Add the entries of a bundle that are not in cache_dir.  Returns the
+    numbers of added, already present and corrupt entries.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    added = present = corrupt = 0
+    # Read as a stream: the bundle may come from a pipe
+    with tarfile.open(fileobj=fobj, mode='r|xz') as tar:
+        entries = None
+        for info in tar:
+            if info.name == MANIFEST:
+                entries = json.load(tar.extractfile(info))['entries']
+                continue
+            name = info.name
+            if entries is None or name not in entries \
+               or os.path.basename(name) != name or not info.isfile():
+                print("Skipping unexpected bundle member {}".format(name))
+                corrupt += 1
+                continue
+            dest = os.path.join(cache_dir, name)
+            if os.path.exists(dest):
+                present += 1
+                continue
+            data = tar.extractfile(info).read()
+            if sha256(data).hexdigest() != entries[name]['sha256']:
+                print("Checksum mismatch: {}".format(name))
+                corrupt += 1
+                continue
+            tmp_file = '{}.{}.tmp'.format(dest, os.getpid())
+            with open(tmp_file, 'wb') as out:
+                out.write(data)
+            os.replace(tmp_file, dest)
+            added += 1
+    return added, present, corrupt
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export or import the cache entries of a build.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    export = commands.add_parser(
+        'export', help='Write the entries used by a build to a bundle')
+    export.add_argument('--cache-dir', default='pretex-cache', type=str,
+                        help='Cache directory')
+    export.add_argument('-o', '--output', default='pretex-cache.tar.xz',
+                        type=str, help='Bundle file to write')
+    export.add_argument('build_dirs', type=str, nargs='+',
+                        help='HTML build directories of the build')
+    imp = commands.add_parser(
+        'import', help='Add the entries of a bundle to a cache')
+    imp.add_argument('--cache-dir', default='pretex-cache', type=str,
+                     help='Cache directory')
+    imp.add_argument('bundle', type=str,
+                     help='Bundle file to read, or - for standard input')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        names = referenced_entries(args.cache_dir, args.build_dirs)
+        size = export_bundle(args.cache_dir, names, args.output)
+        print("Wrote {} entries to {} ({:.1f} MB)".format(
+            len(names), args.output, size / 1e6))
+    else:
+        if args.bundle == '-':
+            result = import_bundle(sys.stdin.buffer, args.cache_dir)
+        else:
+            with open(args.bundle, 'rb') as fobj:
+                result = import_bundle(fobj, args.cache_dir)
+        added, present, corrupt = result
+        print("Added {} entries to {} ({} already there, {} corrupt)".format(
+            added, args.cache_dir, present, corrupt))
+        if corrupt:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+#!env python3
+
+# Cache backends.
+#
+# Cache entries are files named by a hash of their contents or of the LaTeX
+# they were made from: the rendered math of a page (see HTMLDoc.write_cache),
+# and the images and external svgs it refers to.  They live in the cache
+# directory, which is also where pages load the images from.
+#
+# With --remote-cache URL, a ReadThroughCache puts a remote store behind the
+# cache directory: entries missing locally are downloaded, and new entries are
+# uploaded, so builds on other machines can use them.  The remote store is
+# plain http: HEAD, GET and PUT of URL/<name>.  Any server that stores PUT
+# files does; running this file serves a directory like that.
+#
+# Pages show the entries, so only clients with the token in the file given by
+# --remote-cache-token (sent as "Authorization: Bearer <token>") may upload;
+# without it, the remote store is only read.  Downloaded entries that are
+# named by a hash of their contents are checked against it.
+#
+# Lookups are made for many names at once, and the requests are sent in
+# parallel, so that a build doesn't wait for each one in turn.  If the remote
+# store can't be reached, the build goes on with the local cache.
+
+import argparse
+import hmac
+import os
+import re
+import threading
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from shutil import move
+from tempfile import mkstemp
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+
+# Images and external svgs, named by content_hash() of their contents
+CONTENT_NAME_RE = re.compile(r'([-\w]{20})\.(?:png|svg)$')
+
+
+def content_hash(data):
+    "The hash that names images and svgs; as processtex.b64_hash()."
+    return b64encode(md5(data).digest()[:15], b'-_').decode('ascii')
+
+def read_token(fname):
+    "The token in a --remote-cache-token file, or None."
+    if not fname:
+        return None
+    with open(fname) as fobj:
+        return fobj.read().strip()
+
+
+class LocalCache:
+    "Cache entries as files in a directory."
+
+    def __init__(self, path):
+        self.path = path
+
+    def file(self, name):
+        "Where the entry is, when it is available."
+        return os.path.join(self.path, name)
+
+    def exists(self, names):
+        "The subset of names that are in the cache."
+        return set(name for name in names
+                   if os.path.exists(self.file(name)))
+
+    def fetch(self, names):
+        "Make entries available locally; returns the ones that are."
+        return self.exists(names)
+
+    def put(self, name, data):
+        with open(self.file(name), 'wb') as fobj:
+            fobj.write(data)
+
+    def put_file(self, name, fname):
+        "Move a file into the cache."
+        move(fname, self.file(name))
+
+    def close(self):
+        pass
+
+
+class HTTPCache:
+    """
+    Remote store that answers HEAD, GET and PUT of <url>/<name>.  Entries are
+    only uploaded with a token.
+    """
+    def __init__(self, url, workers=16, timeout=10, warn=print, token=None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.warn = warn
+        self.token = token
+        self.workers = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.failed = False
+
+    def _request(self, name, method, data=None):
+        """
+        Send a request; returns the response body, or None if the entry
+        doesn't exist or the store can't be reached.
+        """
+        if self.failed:
+            return None
+        request = Request('{}/{}'.format(self.url, name), data=data,
+                          method=method)
+        if self.token is not None:
+            request.add_header('Authorization', 'Bearer ' + self.token)
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return response.read()
+        except HTTPError as exc:
+            if exc.code != 404:
+                self.warn("Remote cache: {} {}: {}".format(
+                    method, name, exc))
+        except (URLError, OSError) as exc:
+            # Don't wait for the timeout of every request
+            with self.lock:
+                if not self.failed:
+                    self.warn("Remote cache unavailable, using the local "
+                              "cache only: {}".format(exc))
+                self.failed = True
+        return None
+
+    def exists(self, names):
+        names = list(names)
+        found = self.workers.map(
+            lambda name: self._request(name, 'HEAD') is not None, names)
+        return set(name for name, ok in zip(names, found) if ok)
+
+    def get(self, names):
+        "Download entries; returns {name : data} for the ones that exist."
+        names = list(names)
+        datas = self.workers.map(lambda name: self._request(name, 'GET'),
+                                 names)
+        return {name : data for name, data in zip(names, datas)
+                if data is not None}
+
+    def put(self, name, data):
+        "Upload an entry in the background, if there is a token."
+        if self.token is None:
+            return None
+        return self.workers.submit(self._request, name, 'PUT', data)
+
+    def close(self):
+        "Wait for the uploads to finish."
+        self.workers.shutdown()
+
+
+class ReadThroughCache:
+    """
+    Local cache in front of a remote one.  Entries are looked up in the local
+    cache first, downloaded to it when they are only in the remote one, and
+    written to both.
+    """
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+        self.lock = threading.Lock()
+        # Names known not to be in the remote cache
+        self.missing = set()
+
+    def file(self, name):
+        return self.local.file(name)
+
+    def exists(self, names):
+        found = self.local.exists(names)
+        with self.lock:
+            todo = [name for name in names
+                    if name not in found and name not in self.missing]
+        remote = self.remote.exists(todo)
+        with self.lock:
+            self.missing.update(set(todo) - remote)
+        return found | remote
+
+    def fetch(self, names):
+        found = self.local.exists(names)
+        with self.lock:
+            todo = [name for name in names
+                    if name not in found and name not in self.missing]
+        datas = self.remote.get(todo)
+        for name, data in list(datas.items()):
+            match = CONTENT_NAME_RE.match(name)
+            if match and content_hash(data) != match.group(1):
+                self.remote.warn("Remote cache: {} doesn't match its hash, "
+                                 "not using it".format(name))
+                del datas[name]
+                continue
+            # Downloads of the same entry by parallel builds are identical
+            tmp_file = self.file('{}.{}.tmp'.format(name, os.getpid()))
+            with open(tmp_file, 'wb') as fobj:
+                fobj.write(data)
+            os.replace(tmp_file, self.file(name))
+        with self.lock:
+            self.missing.update(set(todo) - set(datas))
+        return found | set(datas)
+
+    def put(self, name, data):
+        self.local.put(name, data)
+        self.remote.put(name, data)
+
+    def put_file(self, name, fname):
+        self.local.put_file(name, fname)
+        with open(self.file(name), 'rb') as fobj:
+            self.remote.put(name, fobj.read())
+
+    def close(self):
+        self.remote.close()
+
+
+def open_cache(cache_dir, remote_url='', workers=16, warn=print,
+               token_file=''):
+    "The cache for the --cache-dir and --remote-cache options."
+    local = LocalCache(cache_dir)
+    if not remote_url:
+        return local
+    return ReadThroughCache(local, HTTPCache(
+        remote_url, workers, warn=warn, token=read_token(token_file)))
+
+
+class StoreHandler(SimpleHTTPRequestHandler):
+    """
+    Serves a directory, and stores files that are PUT in it by clients with
+    self.server.token.
+    """
+    def do_PUT(self):
+        token = self.headers.get('Authorization', '')
+        if self.server.token is None or not hmac.compare_digest(
+                token.encode(), 'Bearer {}'.format(self.server.token).encode()):
+            self.send_error(403)
+            return
+        name = os.path.basename(self.path)
+        if not name or name.startswith('.'):
+            self.send_error(400)
+            return
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        match = CONTENT_NAME_RE.match(name)
+        if match and content_hash(data) != match.group(1):
+            self.send_error(400)
+            return
+        # Unique, for parallel uploads of the same entry
+        fd, tmp_file = mkstemp(prefix='.', suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as fobj:
+            fobj.write(data)
+        os.replace(tmp_file, os.path.join(self.directory, name))
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a directory as a remote cache for --remote-cache.')
+    parser.add_argument('--address', type=str, default='127.0.0.1:8743',
+                        help='host:port to listen on; use 0.0.0.0:<port> to '
+                        'serve other machines')
+    parser.add_argument('--token-file', type=str, default='',
+                        help='File with the token clients need to upload '
+                        'entries (default: entries can only be read)')
+    parser.add_argument('directory', type=str,
+                        help='Directory to store the cache entries in')
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+    host, port = args.address.rsplit(':', 1)
+    server = ThreadingHTTPServer(
+        (host, int(port)),
+        lambda *a: StoreHandler(*a, directory=args.directory))
+    server.token = read_token(args.token_file)
+    print("Serving {} on {}".format(args.directory, args.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!env python3
+
+# Build history, for finding performance regressions.
+#
+# With --history, pretex.py appends a summary of the build report to
+# pretex-history.jsonl in the cache directory after the build.  The summary
+# holds the cost of each stage per unit of work (seconds per file, or per
+# equation of a cached or of a processed file; see stats.work_units()) and the
+# output bytes per equation.  With --compare, a build is compared with a
+# baseline, the median of the previous builds with the same output options,
+# and metrics that grew by more than a threshold are reported.
+#
+# Run this file to compare the last build in a cache directory with the ones
+# before it.
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from hashlib import md5
+
+import stats
+
+
+HISTORY_FILE = 'pretex-history.jsonl'
+
+
+def history_file(cache_dir):
+    return os.path.join(cache_dir, HISTORY_FILE)
+
+def summary(report, preamble, options):
+    "History entry of a build report written by stats.merge()."
+    units = stats.work_units(report)
+    metrics = {}
+    for name, entry in report['stages'].items():
+        num = units[stats.stage_kind(name)]
+        if num:
+            metrics['stage:' + name] = entry['wall'] / num
+    counts = report['counts']
+    equations = counts.get('equations', 0)
+    if equations:
+        for key in stats.SIZE_KEYS + ('bytes_written',):
+            if key in counts:
+                metrics[key] = counts[key] / equations
+    return {
+        'time'         : time.time(),
+        'wall'         : report['wall'],
+        'files'        : counts.get('files', 0),
+        'equations'    : equations,
+        'cache_hits'   : counts.get('cache_hits', 0),
+        'cache_misses' : counts.get('cache_misses', 0),
+        'preamble'     : md5(preamble.encode()).hexdigest(),
+        'options'      : options,
+        'rates'        : stats.work_rates(report, {}),
+        'metrics'      : metrics,
+    }
+
+def append(cache_dir, entry):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(history_file(cache_dir), 'a') as fobj:
+        fobj.write(json.dumps(entry, sort_keys=True) + '\n')
+
+def read(cache_dir):
+    "All entries of the history, oldest first."
+    fname = history_file(cache_dir)
+    if not os.path.exists(fname):
+        return []
+    entries = []
+    with open(fname) as fobj:
+        for line in fobj:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A build was interrupted while writing
+                continue
+    return entries
+
+def latest_rates(cache_dir):
+    "Work rates measured by the builds in the history, newest first."
+    rates = {}
+    for entry in reversed(read(cache_dir)):
+        for key, val in entry.get('rates', {}).items():
+            rates.setdefault(key, val)
+    return rates
+
+def compare(entry, history, num_builds=5, threshold=20):
+    """
+    Compare a build with the median of the last num_builds builds in history
+    with the same options.  Returns a list of (metric, baseline, value) for
+    the metrics that grew by more than threshold percent, and the number of
+    builds in the baseline.
+    """
+    previous = [old for old in history
+                if old['options'] == entry['options']][-num_builds:]
+    regressions = []
+    for name, val in sorted(entry['metrics'].items()):
+        samples = [old['metrics'][name] for old in previous
+                   if name in old['metrics']]
+        if not samples:
+            continue
+        baseline = statistics.median(samples)
+        if baseline and val > baseline * (1 + threshold / 100):
+            regressions.append((name, baseline, val))
+    return regressions, len(previous)
+
+def print_regressions(regressions, num_previous, threshold):
+    "Report the result of compare(); returns whether there are regressions."
+    if not num_previous:
+        print("No previous builds to compare with")
+        return False
+    if not regressions:
+        print("No regressions over {}% compared with {} previous builds"
+              .format(threshold, num_previous))
+        return False
+    print("Regressions over {}% compared with {} previous builds:".format(
+        threshold, num_previous))
+    for name, baseline, val in regressions:
+        print("  {:24s} {:12.6g} -> {:12.6g} ({:+.1f}%)".format(
+            name, baseline, val, 100 * (val / baseline - 1)))
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the last build with the previous ones.')
+    parser.add_argument('--builds', type=int, default=5,
+                        help='Number of previous builds in the baseline')
+    parser.add_argument('--threshold', type=float, default=20,
+                        help='Allowed growth of a metric, in percent')
+    parser.add_argument('cache_dir', type=str,
+                        help='Cache directory of the builds')
+    args = parser.parse_args()
+
+    entries = read(args.cache_dir)
+    if not entries:
+        print("No build history in {}".format(args.cache_dir))
+        sys.exit(1)
+    regressions, num_previous = compare(
+        entries[-1], entries[:-1], args.builds, args.threshold)
+    if print_regressions(regressions, num_previous, args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
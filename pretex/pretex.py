@@ -5,12 +5,23 @@
 
 import argparse
 import glob
+import json
 import os
+import signal
+import socket
 import sys
+import time
 
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Manager, Pool, TimeoutError, cpu_count
 from random import shuffle
-from subprocess import Popen
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+
+import history
+import sharedcss
+import stats
+import watch
+import workqueue
 
 
 PROCESSTEX = os.path.join(os.path.dirname(__file__), 'processtex.py')
@@ -21,10 +32,13 @@ def chunks(l, n):
     for i in range(0, len(l), n):
         yield l[i:i+n]
 
-def job(arg):
-    args, htmls = arg
+def report_file(args, num, kind):
+    "Where chunk number 'num' writes its report of the given kind."
+    return os.path.join(args.report_dir, '{}-{}.json'.format(kind, num))
+
+def processtex_args(args, num):
+    "Command line arguments of processtex for chunk number 'num'."
     cmdline = [
-        'python3', PROCESSTEX,
         '--preamble', args.preamble,
         '--style-path', args.style_path,
         '--cache-dir', args.cache_dir,
@@ -32,10 +46,379 @@ def job(arg):
     ]
     if args.no_cache:
         cmdline.append('--no-cache')
-    proc = Popen(cmdline + htmls)
-    proc.wait()
-    if proc.returncode != 0:
-        raise Exception("Call failed")
+    if args.no_checkpoint:
+        cmdline.append('--no-checkpoint')
+    if args.isolate_errors:
+        cmdline.append('--isolate-errors')
+    if args.remote_cache:
+        cmdline += ['--remote-cache', args.remote_cache,
+                    '--cache-workers', str(args.cache_workers)]
+        if args.remote_cache_token:
+            cmdline += ['--remote-cache-token', args.remote_cache_token]
+    if args.scratch != 'auto':
+        cmdline += ['--scratch', args.scratch]
+    cmdline += ['--scratch-limit', str(args.scratch_limit)]
+    if args.scratch_share:
+        cmdline += ['--scratch-share', str(args.scratch_share)]
+    if args.shared_css:
+        cmdline.append('--shared-css')
+    if args.external_svg:
+        cmdline.append('--external-svg')
+    if args.subset_fonts:
+        cmdline.append('--subset-fonts')
+    cmdline += ['--font-format', args.font_format]
+    if args.ff_workers:
+        cmdline += ['--ff-workers', str(args.ff_workers)]
+    cmdline += ['--ff-batch-size', str(args.ff_batch_size)]
+    if args.record:
+        cmdline += ['--record', args.record]
+    if args.profile:
+        cmdline += ['--profile', os.path.join(
+            args.profile, 'processtex-{}.prof'.format(num))]
+    if args.chunk_stats:
+        cmdline += ['--stats', report_file(args, num, 'stats')]
+    if args.trace:
+        cmdline += ['--trace', report_file(args, num, 'trace')]
+        if not args.queue:
+            # On the track of the pool worker; chunks of queue workers are
+            # on the track of their processtex, named by queue_build()
+            cmdline += ['--trace-pid', str(os.getpid())]
+    if args.plan:
+        cmdline += ['--plan', report_file(args, num, 'plan')]
+    if args.no_server or args.num_chunks > 1:
+        # The render service handles one request at a time
+        cmdline.append('--no-server')
+    if args.memory:
+        cmdline.append('--memory')
+    if args.mem_warn:
+        cmdline += ['--mem-warn', str(args.mem_warn)]
+    return cmdline
+
+def job(arg):
+    """
+    Run processtex on a chunk.  Returns a dict with the exit status, its
+    description, and the html files that were finished.
+    """
+    args, num, htmls = arg
+    if args.cancel.is_set():
+        return {'num' : num, 'status' : None, 'exit' : 'cancelled',
+                'htmls' : htmls, 'done' : []}
+    start = time.time()
+    done = []
+    def on_done(equations, html_file):
+        done.append(html_file)
+        if args.progress is not None:
+            args.progress.put(equations)
+    def on_start(proc):
+        args.running[proc.pid] = num
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+    # pool.terminate() stops the workers with SIGTERM.  Until processtex is in
+    # args.running, where cancel() finds it, that would leave it running.
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+    try:
+        proc = workqueue.run_processtex(
+            ['python3', PROCESSTEX] + processtex_args(args, num), htmls,
+            on_done, on_start)
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+    args.running.pop(proc.pid, None)
+    if args.trace:
+        # One track per pool worker, containing its chunks
+        stats.write_trace([
+            stats.process_name(os.getpid(), 'worker {}'.format(os.getpid())),
+            stats.trace_event('chunk {}'.format(num), 'chunk', start,
+                              time.time() - start, os.getpid(), 0,
+                              {'files' : len(htmls)}),
+        ], report_file(args, num, 'job'))
+    return {'num' : num, 'status' : proc.returncode,
+            'exit' : proc.describe_exit(), 'htmls' : htmls, 'done' : done}
+
+def cancel(pool, args):
+    """
+    Stop the chunks that are running, with the tools they run, and don't
+    start the others.
+    """
+    args.cancel.set()
+    for pid in list(args.running.keys()):
+        workqueue.stop(pid)
+    pool.terminate()
+    # Chunks that started while the pool was being stopped
+    for pid in list(args.running.keys()):
+        workqueue.stop(pid)
+
+def run_chunks(pool, args, job_args, progress):
+    """
+    Run the chunks in the pool.  Unless args.keep_going, the build is
+    cancelled when a chunk fails.  Returns the results of the chunks.
+    """
+    results = []
+    pending = pool.imap_unordered(job, job_args)
+    try:
+        while len(results) < len(job_args):
+            try:
+                result = pending.next(timeout=1)
+            except TimeoutError:
+                result = None
+            if result is not None:
+                results.append(result)
+                if result['status'] != 0 and not args.keep_going:
+                    print("Chunk {} failed (processtex {}); stopping the "
+                          "build".format(result['num'], result['exit']))
+                    cancel(pool, args)
+                    break
+            if progress is not None:
+                while not args.progress.empty():
+                    progress.add(args.progress.get())
+                progress.show(final=len(results) == len(job_args))
+    except BaseException:
+        # Including KeyboardInterrupt: processtex runs in its own process
+        # group, so it doesn't get the SIGINT of the terminal
+        cancel(pool, args)
+        raise
+    return results
+
+def print_failures(results, htmls):
+    "Summarize the chunks that failed and the files that weren't processed."
+    failed = [result for result in results if result['status'] != 0]
+    done = set()
+    for result in results:
+        done.update(result['done'])
+    missing = sorted(set(htmls) - done)
+    if not failed and not missing:
+        return
+    print("Build failed: {} of {} files processed".format(
+        len(htmls) - len(missing), len(htmls)))
+    for result in sorted(failed, key=lambda result: result['num']):
+        print("  chunk {}: processtex {}".format(result['num'],
+                                                 result['exit']))
+    print("Files that failed or were not processed:")
+    for html_file in missing:
+        print("  " + html_file)
+
+class Progress:
+    """
+    Shows the number of finished files and equations, the rate, and the time
+    left.  On a terminal the status line is updated in place every second;
+    otherwise a line is printed every 'interval' seconds.
+    """
+    def __init__(self, num_files, interval, stream=sys.stdout):
+        self.num_files = num_files
+        self.files = 0
+        self.equations = 0
+        self.start = time.time()
+        self.stream = stream
+        self.tty = stream.isatty()
+        self.interval = 1 if self.tty else interval
+        self.last = self.start
+        # Number of files in the last line printed
+        self.shown = None
+
+    def add(self, equations):
+        self.files += 1
+        self.equations += equations
+
+    def status(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        rate = self.files / elapsed
+        if self.files:
+            eta = '{:.0f}s'.format((self.num_files - self.files) / rate)
+        else:
+            eta = '?'
+        return "{}/{} files, {} equations, {:.1f} files/s, " \
+               "{:.1f} equations/s, {} queued, ETA {}".format(
+                   self.files, self.num_files, self.equations, rate,
+                   self.equations / elapsed, self.num_files - self.files, eta)
+
+    def show(self, final=False):
+        now = time.time()
+        if not final and now - self.last < self.interval:
+            return
+        if final and not self.tty and self.shown == self.files:
+            # Printed by the last periodic update
+            return
+        self.last = now
+        self.shown = self.files
+        if self.tty:
+            # Clear the rest of the line after the status
+            self.stream.write('\r' + self.status() + '\x1b[K')
+            if final:
+                self.stream.write('\n')
+            self.stream.flush()
+        else:
+            print(self.status(), file=self.stream, flush=True)
+
+def queue_build(args, job_args, progress):
+    """
+    Put the chunks in the work queue in args.queue, and wait for workers to
+    process them.  Returns the results of the chunks, as run_chunks().
+    """
+    queue = workqueue.WorkQueue(args.queue)
+    names = {}
+    for _, num, htmls in job_args:
+        name = '{}-{:05d}'.format(args.build_id, num)
+        queue.put(name, {'argv'  : processtex_args(args, num),
+                         'htmls' : htmls,
+                         'build' : args.build_id})
+        names[name] = (num, htmls)
+    print("Queued {} chunks in {}".format(len(names), args.queue))
+    results = []
+    try:
+        while names:
+            for name in queue.requeue_expired(args.lease):
+                print("Chunk {} timed out; queued again".format(
+                    names[name][0]))
+            for name in sorted(names):
+                result = queue.result(name)
+                if result is None:
+                    continue
+                result['num'], result['htmls'] = names.pop(name)
+                if progress is not None:
+                    for equations, _ in result['done']:
+                        progress.add(equations)
+                result['done'] = [html_file for _, html_file in result['done']]
+                results.append(result)
+                if args.trace and result.get('pid'):
+                    stats.write_trace([stats.process_name(
+                        result['pid'], 'chunk {} on {}'.format(
+                            result['num'], result['worker']))],
+                        report_file(args, result['num'], 'job'))
+                if result['status'] != 0:
+                    print("Chunk {} failed on {}: processtex {}".format(
+                        result['num'], result['worker'], result['exit']))
+                    if not args.keep_going:
+                        print("Stopping the build")
+                        return results
+            if names:
+                if progress is not None:
+                    progress.show()
+                time.sleep(1)
+    finally:
+        # Cancels the chunks left, and removes results of chunks that ran
+        # twice
+        queue.close(args.build_id)
+    if progress is not None:
+        progress.show(final=True)
+    return results
+
+def watch_build(args, htmls):
+    "Process html files in the build directory again when they change."
+    watcher = watch.Watcher(
+        [args.build_dir, os.path.join(args.build_dir, 'knowl')],
+        args.watch_interval, args.watch_settle)
+    # Files as pretex.py left them, to ignore its own changes
+    written = {path : watch.signature(path) for path in htmls}
+    print("Watching {} for changes{}".format(
+        args.build_dir, '' if watcher.inotify else ' (polling)'))
+    with TemporaryDirectory() as report_dir, Manager() as manager, \
+         Pool(processes=max(cpu_count()-1, 3)) as pool:
+        args.report_dir = report_dir
+        args.progress = None
+        args.chunk_stats = False
+        args.running = manager.dict()
+        args.cancel = manager.Event()
+        try:
+            while True:
+                changed = [path for path in watcher.wait()
+                           if watch.signature(path) != written.get(path)]
+                if not changed:
+                    continue
+                print("Processing {} changed files".format(len(changed)))
+                job_args = [(args, i, chunk) for i, chunk
+                            in enumerate(chunks(changed, args.chunk_size))]
+                args.num_chunks = len(job_args)
+                args.scratch_share = min(max(cpu_count()-1, 3),
+                                         args.num_chunks)
+                # Keep going: the other files are still worth updating
+                print_failures(pool.map(job, job_args), changed)
+                if args.shared_css:
+                    changed = glob_htmls(args.build_dir)
+                    sharedcss.finalize(changed, os.path.join(
+                        args.build_dir, args.shared_css))
+                for path in changed:
+                    written[path] = watch.signature(path)
+                print("Done; watching for changes")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            cancel(pool, args)
+
+def prune_checkpoints(cache_dir, before):
+    """
+    Remove the checkpoints in cache_dir that are older than 'before'.  After
+    a successful build, whose checkpoints are removed once their pages are
+    written, those are left by interrupted builds of pages that changed since,
+    and won't be resumed.  Returns the number removed.
+    """
+    path = os.path.join(cache_dir, 'checkpoints')
+    if not os.path.isdir(path):
+        return 0
+    removed = 0
+    for name in os.listdir(path):
+        try:
+            if os.path.getmtime(os.path.join(path, name)) >= before:
+                continue
+        except OSError:
+            continue
+        rmtree(os.path.join(path, name), ignore_errors=True)
+        removed += 1
+    return removed
+
+def glob_htmls(build_dir):
+    return glob.glob(os.path.join(build_dir, '*.html')) + \
+           glob.glob(os.path.join(build_dir, 'knowl', '*.html'))
+
+def write_profile_report(args, nums):
+    "Merge the profiles of chunks 'nums' into a report in args.profile."
+    if stats.merge_profiles(
+            [os.path.join(args.profile, 'processtex-{}.prof'.format(num))
+             for num in nums], args.profile):
+        print("Wrote profile report to {}".format(
+            os.path.join(args.profile, 'report.txt')))
+
+def print_plan(args, plans, workers):
+    "Print the work to be done by the build, as found by processtex --plan."
+    if args.plan_from:
+        with open(args.plan_from) as fobj:
+            rates = stats.work_rates(json.load(fobj))
+        source = ''
+    else:
+        rates = dict(stats.DEFAULT_RATES,
+                     **history.latest_rates(args.cache_dir))
+        if rates == stats.DEFAULT_RATES:
+            source = ' (no previous build, using defaults)'
+        else:
+            source = ' (from the build history)'
+    summary = stats.plan(plans, rates, workers)
+    print("Files:           {files} ({files_with_math} with math)".format(
+        **summary))
+    print("Cache:           {cache_hits} hits, {cache_misses} misses".format(
+        **summary))
+    print("Equations:       {equations} ({equations_uncached} to render)"
+          .format(**summary))
+    print("Snippets:        {snippets_unique} unique, "
+          "{snippets_duplicate} duplicates, "
+          "{snippets_uncached} unique to render".format(**summary))
+    print("Estimated time:  {:.0f}s on {} processes{}".format(
+        summary['estimated_wall'], workers, source))
+    return summary
+
+def check_sizes(args, report):
+    "Write the size report, and check the page budget."
+    sizes = stats.page_sizes(report, args.page_budget)
+    if args.size_report:
+        with open(args.size_report, 'w') as fobj:
+            json.dump(sizes, fobj, indent=1, sort_keys=True)
+    over = sizes['over_budget']
+    if not over:
+        return
+    print("{} pages are larger than {} bytes:".format(
+        len(over), args.page_budget))
+    # The largest pages come first
+    for page in sizes['pages'][:min(len(over), 20)]:
+        print("  {file}: {total} bytes (svg {bytes_svg}, "
+              "fonts {bytes_fonts}, classes {bytes_classes})".format(**page))
+    if args.budget_action == 'fail':
+        sys.exit(1)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -50,25 +433,273 @@ def main():
                         help='LaTeX image include directory')
     parser.add_argument('--no-cache', action='store_true',
                         help='Ignore cache and regenerate')
+    parser.add_argument('--isolate-errors', action='store_true',
+                        help='Replace equations with LaTeX errors by '
+                        'placeholders instead of failing the chunk')
+    parser.add_argument('--no-checkpoint', action='store_true',
+                        help='Do not save the output of finished stages of '
+                        'each file, to resume interrupted builds')
+    parser.add_argument('--remote-cache', type=str, default='',
+                        help='URL of a remote cache shared between machines, '
+                        'in front of which --cache-dir is used '
+                        '(see cachestore.py)')
+    parser.add_argument('--remote-cache-token', type=str, default='',
+                        help='File with the token to upload to the remote '
+                        'cache with (default: only read it)')
+    parser.add_argument('--cache-workers', type=int, default=16,
+                        help='Parallel requests to the remote cache per chunk')
+    parser.add_argument('--scratch', type=str, default='auto',
+                        help='Where chunks put the scratch files of the '
+                        'external tools: auto (/dev/shm when there is room, '
+                        'else on disk), disk, or a directory')
+    parser.add_argument('--scratch-limit', type=int, default=256,
+                        help='MB of /dev/shm that each chunk running at once '
+                        'needs to use it with --scratch auto')
     parser.add_argument('--chunk-size', type=int, default=50,
                         help='Run processtex on chunks of this size')
+    parser.add_argument('--keep-going', action='store_true',
+                        help='Process the other chunks when one fails, '
+                        'instead of stopping the build')
+    parser.add_argument('--shared-css', type=str, default='',
+                        help='Write css classes to this stylesheet in the '
+                        'build directory, shared by all pages')
+    parser.add_argument('--external-svg', action='store_true',
+                        help='Write displayed equations to separate svg '
+                        'files in the cache directory')
+    parser.add_argument('--font-format', default='woff', type=str,
+                        help='Format of embedded fonts (woff or woff2)')
+    parser.add_argument('--subset-fonts', action='store_true',
+                        help='Remove unused glyphs and tables from fonts')
+    parser.add_argument('--ff-workers', type=int, default=0,
+                        help='FontForge processes per chunk (default: the '
+                        'number of cpus divided by the chunks run at once)')
+    parser.add_argument('--ff-batch-size', type=int, default=20,
+                        help='Number of fonts to convert per FontForge call')
+    parser.add_argument('--stats', type=str, default='',
+                        help='Write a build summary of timings and counts to '
+                        'this json file')
+    parser.add_argument('--trace', type=str, default='',
+                        help='Write a timeline of the build in Trace Event '
+                        'Format to this json file')
+    parser.add_argument('--record', type=str, default='',
+                        help='Save the output of external tools to this '
+                        'directory, for bench/replay.py')
+    parser.add_argument('--profile', type=str, default='',
+                        help='Profile every processtex run, and write the '
+                        'profiles and a merged report to this directory')
+    parser.add_argument('--memory', action='store_true',
+                        help='Include the peak python memory use of each '
+                        'stage in --stats (slow)')
+    parser.add_argument('--mem-warn', type=int, default=0,
+                        help='Warn when a stage or an external tool uses '
+                        'more than this many megabytes')
+    parser.add_argument('--plan', action='store_true',
+                        help='Only report the work to be done and an '
+                        'estimate of the build time, without building')
+    parser.add_argument('--plan-from', type=str, default='',
+                        help='Estimate the build time from this --stats '
+                        'file of a previous build')
+    parser.add_argument('--size-report', type=str, default='',
+                        help='Write the sizes of the parts of each page to '
+                        'this json file')
+    parser.add_argument('--page-budget', type=int, default=0,
+                        help='Maximum size of a page in bytes')
+    parser.add_argument('--budget-action', default='warn',
+                        choices=('warn', 'fail'),
+                        help='What to do with pages over --page-budget')
+    parser.add_argument('--progress', dest='show_progress', action='store_true',
+                        help='Report the finished files and an ETA')
+    parser.add_argument('--progress-interval', type=float, default=30,
+                        help='Seconds between progress lines with --progress '
+                        'when not on a terminal')
+    parser.add_argument('--history', action='store_true',
+                        help='Add this build to the build history in the '
+                        'cache directory')
+    parser.add_argument('--compare', action='store_true',
+                        help='Compare the timings and sizes of this build '
+                        'with the build history; exit with status 1 if '
+                        'some regressed')
+    parser.add_argument('--baseline-builds', type=int, default=5,
+                        help='Number of previous builds to compare with')
+    parser.add_argument('--regression-threshold', type=float, default=20,
+                        help='Report metrics that grew by more than this '
+                        'many percent')
+    parser.add_argument('--no-server', action='store_true',
+                        help='Do not use the render service (server.py) for '
+                        'builds of a single chunk')
+    parser.add_argument('--watch', action='store_true',
+                        help='After the build, keep processing html files '
+                        'that are added or modified')
+    parser.add_argument('--watch-interval', type=float, default=2,
+                        help='Seconds between looking for changes, when '
+                        'inotify_simple is not installed')
+    parser.add_argument('--watch-settle', type=float, default=1,
+                        help='Only process files that have not changed for '
+                        'this many seconds')
+    parser.add_argument('--queue', type=str, default='',
+                        help='Put the chunks in this work queue directory '
+                        'for workqueue.py workers, instead of processing '
+                        'them here')
+    parser.add_argument('--lease', type=float, default=120,
+                        help='Give the chunk of a --queue worker to another '
+                        'one after this many seconds without a heartbeat')
     parser.add_argument('--build-dir', type=str, required=True,
                         help='HTML build directory')
     args = parser.parse_args()
 
-    htmls = glob.glob(os.path.join(args.build_dir, '*.html')) + \
-            glob.glob(os.path.join(args.build_dir, 'knowl', '*.html'))
+    if args.queue:
+        # Workers can run in other directories
+        for name in ('preamble', 'cache_dir', 'img_dir', 'build_dir',
+                     'record', 'profile', 'remote_cache_token'):
+            if getattr(args, name):
+                setattr(args, name, os.path.abspath(getattr(args, name)))
+        args.style_path = ':'.join(os.path.abspath(path) if path else path
+                                   for path in args.style_path.split(':'))
+    htmls = glob_htmls(args.build_dir)
 
     # Process in a random order.  Otherwise one process gets all the section files.
     shuffle(htmls)
 
-    with Pool(processes=max(cpu_count()-1, 3)) as pool:
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    # The size report, the history and the number of LaTeX errors replaced by
+    # placeholders are made from the stats of the chunks
+    args.chunk_stats = bool(args.stats or args.size_report or args.page_budget
+                            or args.history or args.compare
+                            or args.isolate_errors)
+
+    start = time.time()
+    num_procs = max(cpu_count()-1, 3)
+    with TemporaryDirectory() as report_dir, Manager() as manager, \
+         Pool(processes=num_procs) as pool:
+        # Chunks write their reports here
+        args.report_dir = report_dir
+        if args.queue:
+            # Workers write their reports to the queue directory
+            args.build_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+            args.report_dir = os.path.join(args.queue, 'reports',
+                                           args.build_id)
+            os.makedirs(args.report_dir)
+        # Jobs put the number of equations of each finished file here
+        progress = None
+        args.progress = None
+        if args.show_progress and not args.plan:
+            progress = Progress(len(htmls), args.progress_interval)
+            args.progress = manager.Queue()
         job_args = []
-        for chunk in chunks(htmls, args.chunk_size):
-            job_args.append((args, chunk))
-        result = pool.map_async(
-            job, job_args, error_callback=lambda x: pool.close())
-        result.wait()
+        args.num_chunks = (len(htmls) + args.chunk_size - 1) // args.chunk_size
+        if not args.ff_workers and not args.queue and args.num_chunks:
+            # Share the cpus between the chunks that run at once; queue
+            # workers do this for their machine
+            args.ff_workers = max(
+                cpu_count() // min(num_procs, args.num_chunks), 1)
+        # Chunks that run at once each need room for their scratch files
+        args.scratch_share = 0
+        if not args.queue and args.num_chunks:
+            args.scratch_share = min(num_procs, args.num_chunks)
+        for i, chunk in enumerate(chunks(htmls, args.chunk_size)):
+            job_args.append((args, i, chunk))
+        # Process groups of the running chunks, to stop them on failure
+        args.running = manager.dict()
+        args.cancel = manager.Event()
+        if args.queue:
+            results = queue_build(args, job_args, progress)
+        else:
+            results = run_chunks(pool, args, job_args, progress)
+        success = (len(results) == len(job_args)
+                   and all(result['status'] == 0 for result in results))
+        nums = range(len(job_args))
+        if args.plan:
+            if not success:
+                print_failures(results, htmls)
+                sys.exit(1)
+            plans = []
+            for i in nums:
+                with open(report_file(args, i, 'plan')) as fobj:
+                    plans += json.load(fobj)
+            if args.queue:
+                rmtree(args.report_dir, ignore_errors=True)
+            print_plan(args, plans, min(num_procs, len(job_args)))
+            if args.profile:
+                write_profile_report(args, nums)
+            return
+
+        # Reports are written even if the build failed, to see how far it got
+        if args.chunk_stats:
+            report = stats.merge(
+                stats.read_reports(
+                    [report_file(args, i, 'stats') for i in nums]),
+                time.time() - start)
+        if args.stats:
+            with open(args.stats, 'w') as fobj:
+                json.dump(report, fobj, indent=1, sort_keys=True)
+        if args.chunk_stats and report['counts'].get('latex_errors'):
+            print("{} equations with LaTeX errors were replaced by "
+                  "placeholders".format(report['counts']['latex_errors']))
+        if args.trace:
+            stats.merge_traces(
+                [report_file(args, i, kind)
+                 for i in nums for kind in ('job', 'trace')],
+                [stats.process_name(os.getpid(), 'dispatcher'),
+                 stats.trace_event('build', 'build', start,
+                                   time.time() - start, os.getpid(), 0,
+                                   {'files' : len(htmls)})],
+                args.trace)
+        if args.profile:
+            write_profile_report(args, nums)
+        if args.queue:
+            rmtree(args.report_dir, ignore_errors=True)
+    if not success:
+        print_failures(results, htmls)
+        if args.watch:
+            watch_build(args, htmls)
+        sys.exit(1)
+
+    removed = prune_checkpoints(args.cache_dir, start)
+    if removed:
+        print("Removed {} stale checkpoints".format(removed))
+
+    if args.shared_css:
+        sizes = {}
+        num = sharedcss.finalize(
+            htmls, os.path.join(args.build_dir, args.shared_css), sizes)
+        print("Wrote {} shared css classes to {}".format(
+            num, args.shared_css))
+        # The rules moved out of the pages and the shorter class names
+        if args.chunk_stats:
+            stats.add_sizes(report, sizes)
+            if args.stats:
+                with open(args.stats, 'w') as fobj:
+                    json.dump(report, fobj, indent=1, sort_keys=True)
+
+    regressed = False
+    if args.history or args.compare:
+        with open(args.preamble) as fobj:
+            preamble = fobj.read()
+        entry = history.summary(report, preamble, {
+            'shared_css'   : bool(args.shared_css),
+            'external_svg' : args.external_svg,
+            'font_format'  : args.font_format,
+            'subset_fonts' : args.subset_fonts,
+        })
+        if args.compare:
+            regressions, num_previous = history.compare(
+                entry, history.read(args.cache_dir), args.baseline_builds,
+                args.regression_threshold)
+            regressed = history.print_regressions(
+                regressions, num_previous, args.regression_threshold)
+        if args.history:
+            history.append(args.cache_dir, entry)
+
+    # After finalize(), which changes the sizes of the pages
+    if args.size_report or args.page_budget:
+        check_sizes(args, report)
+
+    if args.watch:
+        watch_build(args, htmls)
+    if regressed:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
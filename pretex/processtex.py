@@ -1,19 +1,28 @@
 #!env python3
 
 import argparse
+import cProfile
+import json
 import os
 import re
+import signal
 import sys
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
 from io import StringIO
-from shutil import move
-from subprocess import Popen, PIPE
-from tempfile import TemporaryDirectory
+from shutil import copy, copytree, move, rmtree
+from subprocess import PIPE
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+from tempfile import TemporaryDirectory, TemporaryFile, gettempdir
 
 from lxml import html
 
+import cachestore
+import sharedcss
 import simpletransform
+import stats
 
 
 BASE = os.path.dirname(__file__)
@@ -21,6 +30,31 @@ TOUNICODE = os.path.join(BASE, 'tounicode.py')
 
 PID = os.getpid()
 
+STATS = stats.Stats()
+
+# File to report finished html files to, with --progress-fd
+PROGRESS = None
+
+# A running InkscapeShell to use instead of starting Inkscape
+INKSCAPE = None
+
+# Address of the render service (server.py)
+DEFAULT_SERVER = os.environ.get('PRETEX_SERVER', '127.0.0.1:8742')
+
+# Options the render service runs processtex with.  The others write to other
+# files than the html files and the cache, and are only run locally.
+SERVER_OPTIONS = {
+    'preamble', 'style_path', 'cache_dir', 'img_dir', 'no_cache',
+    'isolate_errors', 'no_checkpoint', 'remote_cache', 'remote_cache_token',
+    'cache_workers', 'scratch', 'scratch_limit', 'scratch_share',
+    'shared_css', 'external_svg', 'font_format', 'subset_fonts', 'ff_workers',
+    'ff_batch_size', 'mem_warn', 'progress_fd', 'server', 'server_timeout',
+    'no_server', 'htmls',
+}
+
+# RAM-backed file system for the scratch files of the external tools
+SHM_DIR = '/dev/shm'
+
 import platform
 if platform.system() == 'Darwin':
     FONTFORGE = '/Applications/FontForge.app/Contents/Resources/opt/local/bin/fontforge'
@@ -30,6 +64,31 @@ else:
 def log(text):
     print("[{:6d}] {}".format(PID, text))
 
+def scratch_dir(scratch, limit, share=1):
+    """
+    Directory to make the scratch directory of a run in.  With 'auto', that's
+    SHM_DIR if at least 'limit' MB of it are free for each of the 'share' runs
+    that use it at once, and the usual temporary directory otherwise; with
+    'disk', always the usual temporary directory.
+    """
+    if scratch == 'disk':
+        return gettempdir()
+    if scratch != 'auto':
+        return scratch
+    try:
+        fs = os.statvfs(SHM_DIR)
+    except OSError:
+        return gettempdir()
+    if os.access(SHM_DIR, os.W_OK) \
+       and fs.f_bavail * fs.f_frsize >= max(share, 1) * limit * 2**20:
+        return SHM_DIR
+    return gettempdir()
+
+def report_done(html):
+    "Tell the dispatcher that a file is finished."
+    if PROGRESS is not None:
+        PROGRESS.write('{} {}\n'.format(len(html.to_replace), html.html_file))
+
 # Snippet to tell fontforge to delete some empty lists.
 # Otherwise the Webkit CFF sanitizer balks.
 # Also, FF seems to incorrectly save default values for some entries.
@@ -54,6 +113,16 @@ FIX_PRIVATE_TABLE = '''
   endif
 '''
 
+# Generate() flags used when subsetting: short 'post' table, no TrueType
+# instructions, no FFTM table.
+STRIP_TABLE_FLAGS = '0x40000c'
+
+# Mime types of the supported font formats
+FONT_FORMATS = {
+    'woff'  : 'application/font-woff',
+    'woff2' : 'font/woff2',
+}
+
 LATEX_PREAMBLE = r'''
 \documentclass[12pt,reqno]{amsart}
 \usepackage[margin=0pt]{geometry}
@@ -146,7 +215,8 @@ svg.pretex {
   text-transform: none;
   position: relative;
 }
-.pretex-display svg.pretex {
+.pretex-display svg.pretex,
+.pretex-display img.pretex {
   /* hack to adjust spacing */
   vertical-align: middle;
 }
@@ -163,21 +233,107 @@ svg.pretex {
 # This is where processed images end up under build/
 FIGURE_IMG_DIR = 'figure-images'
 
+# Compiled instead of snippets with LaTeX errors, with --isolate-errors
+LATEX_PLACEHOLDER = r'\textbf{??}'
+
+# Stages of an HTMLDoc that are checkpointed, in order: the pdf file and
+# boxsize.txt made by LaTeX, the svgs and images made by Inkscape (with
+# boxsize.txt as completed by tounicode.py), and the converted fonts
+CHECKPOINT_STAGES = ('pdf', 'svg', 'fonts')
+
+# Font faces in the pretex-fonts style; the rest of it is class rules
+FONT_FACE_RE = re.compile(r'@font-face \{.*?\}\n', re.S)
+
+
+class ToolError(Exception):
+    """
+    An external tool failed.  Its output has been printed, unless it was run
+    with verbose=False; it is in self.output.
+    """
+    def __init__(self, msg, output=''):
+        super().__init__(msg)
+        self.output = output
+
 
-def check_proc(proc, msg='', stdin=None):
-    "Run a process and die verbosely on error."
+def check_proc(proc, msg='', stdin=None, verbose=True):
+    "Run a process and fail verbosely on error."
     if stdin is not None:
         stdin = stdin.encode('ascii')
     out, err = proc.communicate(input=stdin)
+    if proc.returncode != 0 and not verbose:
+        raise ToolError(msg, out.decode(errors='replace'))
     if proc.returncode != 0:
         print(msg)
+        print("{} {}".format(proc.args[0], proc.describe_exit()))
         print("stdout:")
         print(out.decode())
         print("stderr:")
         print(err.decode())
-        sys.exit(1)
+        raise ToolError(msg)
     return out
 
+def run_proc(cmd, msg='', stdin=None, verbose=True, **kwargs):
+    "Run an external tool, recording it in the trace, and fail on error."
+    name = os.path.basename(cmd[0])
+    with STATS.span(name, 'proc'):
+        proc = stats.Popen(cmd, stdout=PIPE, stderr=PIPE,
+                           stdin=None if stdin is None else PIPE, **kwargs)
+        try:
+            return check_proc(proc, msg, stdin, verbose)
+        finally:
+            STATS.add_process(name, proc)
+
+class InkscapeShell:
+    """
+    A running "inkscape --shell", so that converting pages doesn't pay for
+    starting Inkscape.  Inkscape exports images to its working directory,
+    which can't be changed; run() moves them to the requested directory.
+    """
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+        self.proc = None
+        self.errors = None
+
+    def _wait_prompt(self):
+        "Read output up to the prompt, a line with just '>'."
+        out = b''
+        while not (out == b'>' or out.endswith(b'\n>')):
+            data = os.read(self.proc.stdout.fileno(), 65536)
+            if not data:
+                self.proc.wait()
+                self.proc = None
+                self.errors.seek(0)
+                raise ToolError("Inkscape exited:\n"
+                                + out.decode(errors='replace')
+                                + self.errors.read().decode(errors='replace'))
+            out += data
+        return out
+
+    def run(self, script, cwd):
+        "Run the commands in script, and move exported files to cwd."
+        with STATS.span('inkscape', 'proc'):
+            if self.proc is None:
+                # Kept apart from the output, which could look like a prompt
+                self.errors = TemporaryFile()
+                self.proc = stats.Popen(['inkscape', '--shell'], stdin=PIPE,
+                                        stdout=PIPE, stderr=self.errors,
+                                        cwd=self.work_dir)
+                self._wait_prompt()
+            for line in script.splitlines():
+                self.proc.stdin.write(line.encode() + b'\n')
+                self.proc.stdin.flush()
+                self._wait_prompt()
+        for fname in os.listdir(self.work_dir):
+            move(os.path.join(self.work_dir, fname), os.path.join(cwd, fname))
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.communicate(b'quit\n')
+            self.proc = None
+            self.errors.close()
+
+
 def css_to_dict(css_str):
     "Simple parser."
     # Won't handle complicated things like semicolons in strings.
@@ -230,22 +386,15 @@ class CSSClasses:
     It saves space to use css classes with short names for these.  This class
     acts as a repository for such css classes.
     """
-    ALPHABET = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
     def __init__(self):
         self.class_names = {}
         self.class_vals = {}
-    def _num_to_str(self, number):
-        if 0 <= number < len(self.ALPHABET):
-            return self.ALPHABET[number]
-        text = ''
-        while number != 0:
-            number, i = divmod(number, len(self.ALPHABET))
-            text = self.ALPHABET[i] + text
-        return text
+    def _new_name(self, val):
+        return sharedcss.short_name(len(self.class_names))
     def get(self, val):
         if val in self.class_vals:
             return self.class_vals[val]
-        class_name = self._num_to_str(len(self.class_names))
+        class_name = self._new_name(val)
         self.class_names[class_name] = val
         self.class_vals[val] = class_name
         return class_name
@@ -254,6 +403,15 @@ class CSSClasses:
                        for name, val in sorted(self.class_names.items()))
 
 
+class SharedCSSClasses(CSSClasses):
+    """
+    CSS classes whose names only depend on their values, so they agree across
+    all pages of a build.  See sharedcss.py.
+    """
+    def _new_name(self, val):
+        return sharedcss.placeholder(val)
+
+
 class HTMLDoc:
     """
     Stores all data needed to convert the LaTeX in an html file.
@@ -280,10 +438,16 @@ class HTMLDoc:
         stroke-opacity:    1;
     ''')
 
-    def __init__(self, html_file, preamble, tmp_dir, cache_dir, img_dir):
+    def __init__(self, html_file, preamble, tmp_dir, cache_dir, img_dir,
+                 shared_css=False, external_svg=False, font_format='woff',
+                 subset_fonts=False, html_data=None, cache=None,
+                 checkpoint_dir=None, isolate_errors=False):
+        # With html_data, html_file is only used as a name
         self.html_file = html_file
-        with open(self.html_file) as fobj:
-            self.html_data = fobj.read()
+        if html_data is None:
+            with open(self.html_file) as fobj:
+                html_data = fobj.read()
+        self.html_data = html_data
         parser = html.HTMLParser(remove_comments=True)
         self.dom = html.parse(StringIO(self.html_data), parser=parser)
         self.to_replace = []
@@ -293,15 +457,19 @@ class HTMLDoc:
         self.pdf_dir = os.path.join(self.base_dir, 'pdf')
         self.svg_dir = os.path.join(self.base_dir, 'svg')
         self.out_img_dir = os.path.join(tmp_dir, 'img')
+        self.img_dir = img_dir
         self.cache_dir = cache_dir
-
-        os.makedirs(self.base_dir, exist_ok=True)
-        os.makedirs(self.pdf_dir, exist_ok=True)
-        os.makedirs(self.svg_dir, exist_ok=True)
-        link_dest = os.path.join(self.pdf_dir, 'figure-images')
-        if not os.path.exists(link_dest):
-            os.symlink(os.path.realpath(img_dir), link_dest,
-                       target_is_directory=True)
+        if cache is None:
+            cache = cachestore.LocalCache(cache_dir)
+        self.cache = cache
+        # Where the output of finished stages is saved, to resume after the
+        # process is killed.  None to not save it.
+        self.checkpoint_dir = checkpoint_dir
+        self.restored = None
+        # Replace snippets with LaTeX errors by placeholders, instead of
+        # failing; self.failed holds their indices in self.to_replace
+        self.isolate_errors = isolate_errors
+        self.failed = set()
 
         self.latex_file = os.path.join(self.pdf_dir, self.basename + '.tex')
         self.pdf_file = os.path.join(self.pdf_dir, self.basename + '.pdf')
@@ -313,19 +481,65 @@ class HTMLDoc:
         self.images = []
         self.contents = ''
         self.html_cache = None
-        self.path_classes = CSSClasses()
-        self.tspan_classes = CSSClasses()
+        self.shared_css = shared_css
+        self.external_svg = external_svg
+        self.font_format = font_format
+        self.subset_fonts = subset_fonts
+        if shared_css:
+            self.path_classes = SharedCSSClasses()
+            self.tspan_classes = SharedCSSClasses()
+        else:
+            self.path_classes = CSSClasses()
+            self.tspan_classes = CSSClasses()
 
     @property
     def is_cached(self):
         return os.path.exists(self.html_cache)
 
+    @property
+    def options(self):
+        "Keyword arguments for output options, as passed to __init__()."
+        return {
+            'shared_css'   : self.shared_css,
+            'external_svg' : self.external_svg,
+            'font_format'  : self.font_format,
+            'subset_fonts' : self.subset_fonts,
+        }
+
+    @property
+    def cache_variant(self):
+        "Suffix for cache entries made with non-default output options."
+        flags = ''
+        if self.shared_css:
+            flags += 's'
+        if self.external_svg:
+            flags += 'x'
+        if self.font_format == 'woff2':
+            flags += '2'
+        if self.subset_fonts:
+            flags += 'g'
+        return '-' + flags if flags else ''
+
+    def make_dirs(self):
+        """
+        Make the scratch directories for the external tools.  Files that are
+        cached or have no math never need them.
+        """
+        os.makedirs(self.pdf_dir, exist_ok=True)
+        os.makedirs(self.svg_dir, exist_ok=True)
+        link_dest = os.path.join(self.pdf_dir, 'figure-images')
+        if not os.path.exists(link_dest):
+            os.symlink(os.path.realpath(self.img_dir), link_dest,
+                       target_is_directory=True)
+
     def svg_file(self, num):
         return os.path.join(self.svg_dir, 'out{:03d}.svg'.format(num+1))
 
     def make_latex(self):
         "Extract math from the html file, then make a LaTeX file."
         self.to_replace = []
+        # Index in pages and template of each element of to_replace
+        self.snippet_pages = []
         pages = []
         for elt in self.dom.getiterator('script'):
             if not elt.attrib.get('type', '').startswith('text/x-latex-'):
@@ -335,11 +549,9 @@ class HTMLDoc:
             code = elt.text.strip()
             typ = elt.attrib['type']
             if typ == 'text/x-latex-inline':
-                pages.append(LATEX_INLINE.format(code=code))
-                pages.append(LATEX_NEWPAGE)
+                template = LATEX_INLINE
             elif typ == 'text/x-latex-code-inline':
-                pages.append(LATEX_CODE_INLINE.format(code=code))
-                pages.append(LATEX_NEWPAGE)
+                template = LATEX_CODE_INLINE
             elif typ == 'text/x-latex-code-bare':
                 # Use raw code
                 pages.append(code)
@@ -347,40 +559,144 @@ class HTMLDoc:
             elif typ in ('text/x-latex-display', 'text/x-latex-code'):
                 if code.find(r'\tag') != -1:
                     code = code.replace(r'\tag', r'\postag')
-                pages.append(LATEX_DISPLAY.format(code=code, pageno=len(pages)))
-                pages.append(LATEX_NEWPAGE)
+                template = LATEX_DISPLAY
+            else:
+                continue
+            self.snippet_pages.append((len(pages), template))
+            pages.append(template.format(code=code, pageno=len(pages)))
+            pages.append(LATEX_NEWPAGE)
             self.to_replace.append(elt)
         if not pages:
             return False
         if pages[-1] == LATEX_NEWPAGE:
             pages = pages[:-1]
-        contents = ''
-        with open(self.latex_file, 'w') as fobj:
-            fobj.write(LATEX_PREAMBLE)
-            fobj.write(self.preamble)
-            fobj.write(LATEX_BEGIN)
-            fobj.write(''.join(pages))
-            fobj.write(r'\end{document}')
-            contents += LATEX_PREAMBLE
-            contents += self.preamble
-            contents += LATEX_BEGIN
-            contents += ''.join(pages)
-            contents += r'\end{document}'
+        self.pages = pages
+        # Written to a file by latex(), if the file isn't cached
+        contents = self._latex_contents(pages)
         # Now we know the hash file name
         self.contents_hash = b64_hash(contents)
-        self.html_cache = os.path.join(self.cache_dir, self.contents_hash)
+        self.cache_name = self.contents_hash + self.cache_variant
+        self.html_cache = self.cache.file(self.cache_name)
         self.contents = contents
         return True
 
+    def _latex_contents(self, pages):
+        return LATEX_PREAMBLE + self.preamble + LATEX_BEGIN \
+               + ''.join(pages) + r'\end{document}'
+
+    def _write_latex(self, pages):
+        "Write the LaTeX file for a list of pages."
+        with open(self.latex_file, 'w') as fobj:
+            fobj.write(self._latex_contents(pages))
+
     def latex(self):
-        "Compile the file generated by self.make_latex()"
-        proc = Popen(['pdflatex', '-interaction=nonstopmode',
+        "Compile the LaTeX made by self.make_latex()"
+        self.make_dirs()
+        if self.isolate_errors:
+            self._latex_isolated()
+            return
+        self._write_latex(self.pages)
+        run_proc(['pdflatex', '-interaction=nonstopmode',
+                  '\\input{' + os.path.basename(self.latex_file) + '}'],
+                 'Failed to compile LaTeX in {}'.format(self.html_file) + '\n'
+                 + 'Contents of .tex file:\n'
+                 + self.contents,
+                 cwd=self.pdf_dir)
+
+    def _replaced_pages(self, failed):
+        "The pages with the snippets in 'failed' replaced by a placeholder."
+        pages = list(self.pages)
+        for num in failed:
+            page, template = self.snippet_pages[num]
+            pages[page] = template.format(code=LATEX_PLACEHOLDER, pageno=page)
+        return pages
+
+    def _compile(self, failed):
+        """
+        Compile with the snippets with indices in 'failed' replaced by a
+        placeholder.  Returns None on success, or the output of pdflatex.
+        """
+        self._write_latex(self._replaced_pages(failed))
+        try:
+            run_proc(['pdflatex', '-interaction=nonstopmode',
                       '\\input{' + os.path.basename(self.latex_file) + '}'],
-                     cwd=self.pdf_dir, stdout=PIPE, stderr=PIPE)
-        check_proc(proc, 'Failed to compile LaTeX in {}'.format(
-            self.html_file) + '\n'
-                   + 'Contents of .tex file:\n'
-                   + self.contents)
+                     verbose=False, cwd=self.pdf_dir)
+        except ToolError as exc:
+            return exc.output
+        return None
+
+    def _failed_snippet(self, output, failed):
+        """
+        The snippet at the line of the first error in the output of
+        self._compile(failed), or None.
+        """
+        match = re.search(r'^l\.(\d+)', output, re.M)
+        if not match:
+            return None
+        lineno = int(match.group(1))
+        # Line of the .tex file each page starts on
+        line = 1 + (LATEX_PREAMBLE + self.preamble + LATEX_BEGIN).count('\n')
+        starts = []
+        for page in self._replaced_pages(failed):
+            starts.append(line)
+            line += page.count('\n')
+        for num, (page, _) in enumerate(self.snippet_pages):
+            end = starts[page + 1] if page + 1 < len(starts) else line + 1
+            if starts[page] <= lineno < end:
+                return None if num in failed else num
+        return None
+
+    def _fails_alone(self, num):
+        "Whether pdflatex fails with all snippets but 'num' replaced."
+        return self._compile(
+            set(range(len(self.to_replace))) - {num}) is not None
+
+    def _bisect(self):
+        """
+        Find a snippet that makes pdflatex fail by compiling with halves of
+        the remaining snippets.  Returns None if it fails without them.
+        """
+        candidates = [num for num in range(len(self.to_replace))
+                      if num not in self.failed]
+        placeholders = self.failed | set(candidates)
+        if self._compile(placeholders) is not None:
+            return None
+        while len(candidates) > 1:
+            # Compile with only the first half of the candidates
+            half = candidates[:len(candidates) // 2]
+            if self._compile(placeholders - set(half)) is None:
+                candidates = candidates[len(half):]
+            else:
+                candidates = half
+        return candidates[0]
+
+    def _latex_isolated(self):
+        """
+        Compile, replacing snippets that don't compile by placeholders.  Their
+        indices are added to self.failed.
+        """
+        output = self._compile(self.failed)
+        while output is not None:
+            num = self._failed_snippet(output, self.failed)
+            if num is not None:
+                # TeX can report an error after the snippet that made it, so
+                # the snippet must fix the file or fail by itself
+                output = self._compile(self.failed | {num})
+                if output is not None and not self._fails_alone(num):
+                    num = None
+            if num is None:
+                num = self._bisect()
+                if num is None:
+                    # Not the fault of a snippet: fail as usual
+                    self.isolate_errors = False
+                    self.latex()
+                    return
+                output = self._compile(self.failed | {num})
+            log("LaTeX error in {}, replaced by a placeholder:\n{}".format(
+                os.path.basename(self.html_file),
+                self.to_replace[num].text.strip()))
+            STATS.add('latex_errors', 1, self.html_file)
+            self.failed.add(num)
 
     def read_extents(self):
         "Parse boxsize.txt and populate size data."
@@ -462,15 +778,153 @@ class HTMLDoc:
         script = ''
         for page_num in range(self.num_pages):
             script += '--file="{}" --pdf-page={}' \
-                      ' --export-plain-svg="{}"\n' \
+                      ' --export-plain-svg="{}"' \
                       .format(self.pdf_file, page_num+1,
                               self.svg_file(page_num))
+            if self.external_svg and self.pages_extents[page_num]['display']:
+                # Standalone svg files can't use the fonts in the page
+                script += ' --export-text-to-path'
+            script += '\n'
         return script
 
-    def add_font(self, name, fname):
-        with open(fname, 'rb') as fobj:
-            self.fonts[name] = fobj.read()
-        self.font_hashes[name] = 'f'+b64_hash(self.fonts[name])
+    def used_glyphs(self):
+        "Return the characters used in each font in the generated svgs."
+        used = {}
+        for page_num in range(self.num_pages):
+            with open(self.svg_file(page_num), 'rb') as fobj:
+                svg = html.fromstring(fobj.read())
+            for tspan in svg.xpath('//tspan[@style]'):
+                css = css_to_dict(tspan.attrib['style'])
+                font_family = css.get('font-family', '').split(',')[0]
+                if font_family and tspan.text:
+                    used.setdefault(font_family, set()).update(tspan.text)
+        return used
+
+    def add_font(self, name, data, font_hash):
+        "Use a converted font; its data may be shared with other pages."
+        self.fonts[name] = data
+        self.font_hashes[name] = font_hash
+
+    def exported_images(self):
+        "Images exported by inkscape for the svgs of this file."
+        fnames = []
+        for page_num in range(self.num_pages):
+            with open(self.svg_file(page_num)) as fobj:
+                hrefs = re.findall(r'xlink:href="([^"]+)"', fobj.read())
+            for href in hrefs:
+                fname = os.path.join(self.out_img_dir, os.path.basename(href))
+                if os.path.exists(fname):
+                    fnames.append(fname)
+        return fnames
+
+    def checkpoint(self, stage):
+        """
+        Save the output of a finished stage (see CHECKPOINT_STAGES) in the
+        checkpoint directory.
+        """
+        if self.checkpoint_dir is None or self.failed:
+            return
+        path = os.path.join(self.checkpoint_dir, self.cache_name)
+        if os.path.exists(os.path.join(path, stage)):
+            return
+        with STATS.stage('checkpoint', self.html_file):
+            # Stages appear complete or not at all
+            tmp_dir = os.path.join(path, '{}.{}.tmp'.format(
+                stage, os.getpid()))
+            os.makedirs(tmp_dir)
+            if stage == 'pdf':
+                copy(self.pdf_file, os.path.join(tmp_dir, 'out.pdf'))
+                copy(self.boxsize_file, tmp_dir)
+            elif stage == 'svg':
+                # Now with the extents of displayed equations
+                copy(self.boxsize_file, tmp_dir)
+                copytree(self.svg_dir, os.path.join(tmp_dir, 'svg'))
+                os.makedirs(os.path.join(tmp_dir, 'img'))
+                for fname in self.exported_images():
+                    copy(fname, os.path.join(tmp_dir, 'img'))
+            elif stage == 'fonts':
+                for name, data in self.fonts.items():
+                    with open(os.path.join(tmp_dir, self.font_hashes[name]),
+                              'wb') as fobj:
+                        fobj.write(data)
+                with open(os.path.join(tmp_dir, 'fonts.json'), 'w') as fobj:
+                    json.dump(self.font_hashes, fobj)
+            try:
+                os.rename(tmp_dir, os.path.join(path, stage))
+            except OSError:
+                # Saved by another process for a file with the same LaTeX
+                rmtree(tmp_dir)
+
+    def restore_checkpoint(self):
+        """
+        Put the output of the checkpointed stages in place of running them.
+        Returns the last stage restored, or None.
+        """
+        self.restored = None
+        if self.checkpoint_dir is None:
+            return None
+        path = os.path.join(self.checkpoint_dir, self.cache_name)
+        if not os.path.isdir(path):
+            return None
+        self.make_dirs()
+        for stage in CHECKPOINT_STAGES:
+            src = os.path.join(path, stage)
+            if not os.path.isdir(src):
+                break
+            if stage == 'pdf':
+                copy(os.path.join(src, 'out.pdf'), self.pdf_file)
+                copy(os.path.join(src, 'boxsize.txt'), self.boxsize_file)
+            elif stage == 'svg':
+                rmtree(self.svg_dir)
+                copytree(os.path.join(src, 'svg'), self.svg_dir)
+                os.makedirs(self.out_img_dir, exist_ok=True)
+                for fname in os.listdir(os.path.join(src, 'img')):
+                    copy(os.path.join(src, 'img', fname), self.out_img_dir)
+            elif stage == 'fonts':
+                # tounicode.py won't run to complete boxsize.txt.  It isn't
+                # restored with the svgs, since it would be completed twice.
+                copy(os.path.join(path, 'svg', 'boxsize.txt'),
+                     self.boxsize_file)
+                with open(os.path.join(src, 'fonts.json')) as fobj:
+                    font_hashes = json.load(fobj)
+                for name, font_hash in font_hashes.items():
+                    with open(os.path.join(src, font_hash), 'rb') as fobj:
+                        self.add_font(name, fobj.read(), font_hash)
+            self.restored = stage
+        return self.restored
+
+    def remove_checkpoint(self):
+        if self.checkpoint_dir is not None:
+            rmtree(os.path.join(self.checkpoint_dir, self.cache_name),
+                   ignore_errors=True)
+
+    def record(self, record_dir):
+        """
+        Save the output of the external tools, so that the python stages can
+        be replayed without them.  See bench/replay.py.
+        """
+        dest = os.path.join(record_dir, self.basename)
+        if os.path.exists(dest):
+            rmtree(dest)
+        os.makedirs(os.path.join(dest, 'fonts'))
+        os.makedirs(os.path.join(dest, 'img'))
+        with open(os.path.join(dest, 'input.html'), 'w') as fobj:
+            fobj.write(self.html_data)
+        copy(self.boxsize_file, os.path.join(dest, 'boxsize.txt'))
+        copytree(self.svg_dir, os.path.join(dest, 'svg'))
+        for fname in self.exported_images():
+            copy(fname, os.path.join(dest, 'img'))
+        for name, data in self.fonts.items():
+            with open(os.path.join(dest, 'fonts', self.font_hashes[name]),
+                      'wb') as fobj:
+                fobj.write(data)
+        with open(os.path.join(dest, 'meta.json'), 'w') as fobj:
+            json.dump({
+                'html_file' : os.path.basename(self.html_file),
+                'preamble'  : self.preamble,
+                'options'   : self.options,
+                'fonts'     : self.font_hashes,
+            }, fobj, indent=1, sort_keys=True)
 
     def write_cache(self, style, fonts, svgs):
         "Cache the computed data in an xml file"
@@ -484,8 +938,7 @@ class HTMLDoc:
         for svg in svgs:
             svg.tail = ''
             cache.append(svg)
-        with open(self.html_cache, 'wb') as fobj:
-            fobj.write(html.tostring(cache))
+        self.cache.put(self.cache_name, html.tostring(cache))
 
     def _replace_elt(self, elt, svg):
         "Replace an element with an svg, using a binding wrapper if necessary."
@@ -546,30 +999,56 @@ class HTMLDoc:
         for elt in root.find('body'):
             elt.attrib['class'] = add_class(elt.attrib.get('class'), base_class)
 
+    def _write_dom(self, outfile, style, fonts, svgs):
+        data = html.tostring(
+            self.dom, include_meta_content_type=True, encoding='utf-8')
+        with open(outfile, 'wb') as outf:
+            outf.write(data)
+        STATS.add('bytes_written', len(data), self.html_file)
+        # Where the bytes of the page come from
+        font_data = sum(len(face) for face in FONT_FACE_RE.findall(fonts))
+        sizes = {
+            'bytes_svg'     : sum(len(html.tostring(svg, with_tail=False))
+                                  for svg in svgs),
+            'bytes_fonts'   : font_data,
+            'bytes_css'     : len(style.encode()),
+            'bytes_classes' : len(fonts.encode()) - font_data,
+        }
+        sizes['bytes_html'] = len(data) - sum(sizes.values())
+        for name, num in sizes.items():
+            STATS.add(name, num, self.html_file)
+
     def use_cached(self, outfile):
         "Write the cached output to the html file."
         with open(self.html_cache, 'rb') as fobj:
             cache = html.fromstring(fobj.read())
         style = cache[0].text
         fonts = cache[1].text
+        # Images and external svgs of the page may be in a remote cache
+        prefix = FIGURE_IMG_DIR + '/'
+        self.images = [url[len(prefix):]
+                       for url in cache.xpath('//image/@href | //img/@src')
+                       if url.startswith(prefix)]
+        self.cache.fetch(self.images)
         # Replace DOM elements
+        svgs = []
         for elt in self.to_replace:
             svg = cache[2]
             self._replace_elt(elt, svg)
+            svgs.append(svg)
         self._rewrite_common(style, fonts)
-        with open(outfile, 'wb') as outf:
-            outf.write(html.tostring(
-                self.dom, include_meta_content_type=True, encoding='utf-8'))
+        self._write_dom(outfile, style, fonts, svgs)
 
     def write_html(self, outfile):
-        svgs = self.process_svgs()
-        cached_elts = []
-        # Replace DOM elements
-        for i, elt in enumerate(self.to_replace):
-            self._replace_elt(elt, svgs[i])
-            cached_elts.append(svgs[i])
-        style = PRETEX_STYLE
-        style += r'''
+        with STATS.stage('process_svgs', self.html_file):
+            svgs = self.process_svgs()
+        STATS.add('svgs', len(svgs), self.html_file)
+        with STATS.stage('write_html', self.html_file):
+            self._write_html(outfile, svgs)
+
+    def page_style(self):
+        "The contents of the pretex-style element."
+        return PRETEX_STYLE + r'''
 svg.pretex text {{
   {}
 }}
@@ -577,28 +1056,42 @@ svg.pretex path {{
   {}
 }}
 '''.format(dict_to_css(self.DEFAULT_TEXT), dict_to_css(self.DEFAULT_PATH))
+
+    def font_faces(self):
+        "Font data by font hash."
+        # Merged fonts are registered under several names
+        return {self.font_hashes[name] : data
+                for name, data in self.fonts.items()}
+
+    def _write_html(self, outfile, svgs):
+        cached_elts = []
+        # Replace DOM elements
+        for i, elt in enumerate(self.to_replace):
+            if i in self.failed:
+                # Show the code that didn't compile
+                svgs[i] = html.Element('code', {'class' : 'pretex-error',
+                                                'title' : 'LaTeX error'})
+                svgs[i].text = elt.text.strip()
+            self._replace_elt(elt, svgs[i])
+            cached_elts.append(svgs[i])
+        style = self.page_style()
         # Add fonts
         font_style = '\n/* pretex cache: {} */\n'.format(self.contents_hash)
-        for name, data in self.fonts.items():
-            name = self.font_hashes[name]
-            font_style += r'''
-@font-face {{
-  font-family: "{name}";
-  src: url(data:application/font-woff;base64,{data}) format('woff');
-}}
-'''.format(name=name, data=b64encode(data).decode('ascii'))
+        font_style += font_face_css(self.font_faces(), self.font_format)
         font_style += '\n'
         # These go here so they show up in knowls too
-        base_class = 'C' + self.contents_hash
-        font_style += self.tspan_classes.css(
-            '.{} svg.pretex tspan'.format(base_class))
-        font_style += self.path_classes.css(
-            '.{} svg.pretex path'.format(base_class))
+        if self.shared_css:
+            # Moved to the shared stylesheet by sharedcss.finalize()
+            prefix = ''
+        else:
+            prefix = '.{} '.format('C' + self.contents_hash)
+        font_style += self.tspan_classes.css(prefix + 'svg.pretex tspan')
+        font_style += self.path_classes.css(prefix + 'svg.pretex path')
         self._rewrite_common(style, font_style)
-        with open(outfile, 'wb') as outf:
-            outf.write(html.tostring(
-                self.dom, include_meta_content_type=True, encoding='utf-8'))
-        self.write_cache(style, font_style, cached_elts)
+        self._write_dom(outfile, style, font_style, cached_elts)
+        if not self.failed:
+            # Otherwise the errors would be cached
+            self.write_cache(style, font_style, cached_elts)
 
     def process_svgs(self):
         "Process all generated svgs file for use in an html page."
@@ -606,6 +1099,12 @@ svg.pretex path {{
         for page_num, page_extents in enumerate(self.pages_extents):
             with open(self.svg_file(page_num), 'rb') as fobj:
                 svg = html.fromstring(fobj.read())
+            # Standalone svg files can't load images or use the page's css.
+            # Placeholders of failed displays are replaced, and not cached.
+            external = (self.external_svg and page_extents['display']
+                        and page_num not in self.failed
+                        and not svg.xpath('//image'))
+            path_classes = CSSClasses() if external else self.path_classes
             # Remove extra attrs from <svg>
             for key in svg.attrib.keys():
                 if key not in self.SVG_ATTRS:
@@ -654,7 +1153,7 @@ svg.pretex path {{
                 self.process_tspan(tspan, page_extents['fontsize'])
             # Clean up path styles
             for path in svg.xpath('//path[@style]'):
-                self.process_path(path)
+                self.process_path(path, path_classes)
             # Process linked images
             for img in svg.xpath('//image'):
                 self.process_image(img)
@@ -668,6 +1167,10 @@ svg.pretex path {{
                     elt.drop_tree()
                     if parent.tag == 'g' and len(parent) == 0:
                         todelete.append(parent)
+            if external:
+                svg = self.externalize_svg(
+                    svg, path_classes, page_extents,
+                    self.to_replace[page_num].text.strip())
             if page_extents['display']:
                 # Wrap displayed equations
                 div = html.Element('div', {'class' : 'pretex-display'})
@@ -752,8 +1255,37 @@ svg.pretex path {{
                 self.tspan_classes.get(';'.join(css_val))
             )
 
-    def process_path(self, path):
+    def externalize_svg(self, svg, path_classes, page_extents, code):
+        "Write a displayed equation to its own svg file; return an <img>."
+        style = html.Element('style')
+        style.text = 'path {{ {} }}\n'.format(dict_to_css(self.DEFAULT_PATH))
+        style.text += path_classes.css('path')
+        svg.insert(0, style)
+        # The <img> is sized in ems, like the inline svg would have been
+        del svg.attrib['height']
+        data = html.tostring(svg, method='xml', encoding='utf-8')
+        data = data.replace(
+            b'<svg', b'<svg xmlns="http://www.w3.org/2000/svg"', 1)
+        # Identical equations on different pages share a file
+        svg_name = b64_hash(data) + '.svg'
+        self.images.append(svg_name)
+        self.cache.put(svg_name, data)
+        STATS.add('external_svgs')
+        return html.Element('img', {
+            'class'    : 'pretex',
+            'src'      : FIGURE_IMG_DIR + '/' + svg_name,
+            'alt'      : code,
+            'loading'  : 'lazy',
+            'decoding' : 'async',
+            'style'    : 'width:{}em;height:{}em'.format(
+                smart_float(page_extents['widthem']),
+                smart_float(page_extents['heightem'])),
+        })
+
+    def process_path(self, path, path_classes=None):
         "Simplify <path> tag."
+        if path_classes is None:
+            path_classes = self.path_classes
         css = css_to_dict(path.attrib.get('style', ''))
         # Get rid of inherited styles
         for key in self.DEFAULT_PATH:
@@ -783,7 +1315,7 @@ svg.pretex path {{
         if css_val:
             path.attrib['class'] = add_class(
                 path.attrib.get('class'),
-                self.path_classes.get(';'.join(css_val))
+                path_classes.get(';'.join(css_val))
             )
 
     def process_image(self, img):
@@ -797,9 +1329,10 @@ svg.pretex path {{
             img_hash = b64_hash(fobj.read())
         img_name = img_hash + '.png'
         self.images.append(img_name)
+        STATS.add('images', 1, self.html_file)
         img.attrib['href'] = FIGURE_IMG_DIR + '/' + img_name
         # Move to the cache directory
-        move(fname, os.path.join(self.cache_dir, img_name))
+        self.cache.put_file(img_name, fname)
         # Simplify css
         css = css_to_dict(img.get('style', ''))
         css.pop('image-rendering', 1)
@@ -808,6 +1341,19 @@ svg.pretex path {{
             del img.attrib['style']
 
 
+def font_face_css(faces, font_format):
+    "@font-face rules for fonts given by font hash."
+    css = ''
+    for name, data in sorted(faces.items()):
+        css += r'''
+@font-face {{
+  font-family: "{name}";
+  src: url(data:{mime};base64,{data}) format('{format}');
+}}
+'''.format(name=name, mime=FONT_FORMATS[font_format],
+           format=font_format, data=b64encode(data).decode('ascii'))
+    return css
+
 def almost_zero(num, ε=0.0001):
     return abs(num) < ε
 
@@ -904,7 +1450,128 @@ def unwrap_transforms(svg):
     return True
 
 
-def main():
+def font_jobs(html_files, sfd_dir, woff_dir):
+    """
+    Group the fonts saved by tounicode.py into conversion jobs.  When
+    subsetting, subsets of the same font in one html file are merged, and
+    glyphs that don't appear in the svgs are removed, and fonts none of whose
+    glyphs appear are left out.  Identical jobs for different html files are
+    only run once.
+    """
+    html_byhash = {html.basename : html for html in html_files}
+    by_html = {}
+    with open(os.path.join(sfd_dir, 'manifest.jsonl')) as fobj:
+        for line in fobj:
+            entry = json.loads(line)
+            by_html.setdefault(entry['pdf'], []).append(entry)
+            STATS.add('fonts_extracted')
+    jobs = {}
+    for hash_name, entries in sorted(by_html.items()):
+        html = html_byhash[hash_name]
+        used = html.used_glyphs() if html.subset_fonts else None
+        groups = {}
+        for entry in entries:
+            # Inkscape replaces the "+" in subset font names by a space
+            name = entry['font'].replace('+', ' ')
+            if used is not None and entry['standard_names']:
+                key = name.split(' ', 1)[-1]
+            else:
+                key = name
+            groups.setdefault(key, []).append((name, entry['sfd']))
+        for key, members in sorted(groups.items()):
+            names = [name for name, _ in members]
+            sfds = tuple(sorted(set(sfd for _, sfd in members)))
+            codepoints = None
+            if used is not None:
+                codepoints = set()
+                for name in names:
+                    codepoints.update(ord(c) for c in used.get(name, ''))
+                codepoints = frozenset(codepoints)
+                if not codepoints:
+                    # Only used by svgs with text converted to paths, or by
+                    # images
+                    STATS.add('fonts_unused')
+                    continue
+            job_key = (sfds, codepoints)
+            if job_key not in jobs:
+                if codepoints is None and len(sfds) == 1:
+                    out_name = sfds[0][:-4]
+                elif codepoints is None:
+                    out_name = b64_hash(repr(sfds))
+                else:
+                    out_name = b64_hash(repr((sfds, sorted(codepoints))))
+                jobs[job_key] = {
+                    'sfds'       : [os.path.join(sfd_dir, sfd)
+                                    for sfd in sfds],
+                    'out'        : os.path.join(woff_dir, '{}.{}'.format(
+                        out_name, html.font_format)),
+                    'codepoints' : codepoints,
+                    'users'      : [],
+                }
+            jobs[job_key]['users'].append((html, names))
+    return list(jobs.values())
+
+def font_script(job):
+    "FontForge script for a conversion job."
+    script = 'Open("{}")\n'.format(job['sfds'][0])
+    for sfd in job['sfds'][1:]:
+        script += 'MergeFonts("{}")\n'.format(sfd)
+    script += FIX_PRIVATE_TABLE
+    if job['codepoints'] is None:
+        script += 'Generate("{}")\n'.format(job['out'])
+        return script
+    script += 'SelectNone()\n'
+    script += 'SelectMoreIf(".notdef")\n'
+    for chunk in chunks(sorted(job['codepoints']), 50):
+        script += 'SelectMoreIf({})\n'.format(
+            ', '.join('0u{:04x}'.format(cp) for cp in chunk))
+    script += 'SelectInvert()\n'
+    script += 'DetachAndRemoveGlyphs()\n'
+    script += 'Generate("{}", "", {})\n'.format(
+        job['out'], STRIP_TABLE_FLAGS)
+    return script
+
+def convert_batch(jobs):
+    """
+    Run FontForge on a batch of conversion jobs.  If it fails, bisect the
+    batch to isolate the bad fonts.  Returns the jobs that failed on their own.
+    """
+    with STATS.span('fontforge', 'proc', fonts=len(jobs)):
+        proc = stats.Popen([FONTFORGE, '-lang=ff', '-script', '-'],
+                           stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        _, err = proc.communicate(
+            ''.join(font_script(job) for job in jobs).encode('ascii'))
+    STATS.add_process('fontforge', proc)
+    if proc.returncode == 0:
+        return []
+    if len(jobs) == 1:
+        log("Could not convert font {} ({}):\n{}".format(
+            ', '.join(jobs[0]['sfds']), proc.describe_exit(),
+            err.decode(errors='replace')))
+        return jobs
+    mid = len(jobs) // 2
+    return convert_batch(jobs[:mid]) + convert_batch(jobs[mid:])
+
+def convert_fonts(jobs, num_workers, batch_size):
+    """
+    Convert fonts using several FontForge processes.  Small batches keep ff
+    from segfaulting and limit the work redone when it does.  Returns the jobs
+    that failed.
+    """
+    failed = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for result in executor.map(convert_batch,
+                                   list(chunks(jobs, batch_size))):
+            failed += result
+    return failed
+
+def chunks(l, n):
+    "Yield successive n-sized chunks from l."
+    for i in range(0, len(l), n):
+        yield l[i:i+n]
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description='Process LaTeX in html files.')
     parser.add_argument('--preamble', default='preamble.tex', type=str,
@@ -917,110 +1584,393 @@ def main():
                         help='LaTeX image include directory')
     parser.add_argument('--no-cache', action='store_true',
                         help='Ignore cache and regenerate')
+    parser.add_argument('--isolate-errors', action='store_true',
+                        help='Replace equations with LaTeX errors by '
+                        'placeholders instead of failing; pages with '
+                        'placeholders are not cached')
+    parser.add_argument('--no-checkpoint', action='store_true',
+                        help='Do not save the output of finished stages in '
+                        'the cache directory to resume interrupted runs')
+    parser.add_argument('--remote-cache', type=str, default='',
+                        help='URL of a remote cache to read through and '
+                        'write to (see cachestore.py)')
+    parser.add_argument('--remote-cache-token', type=str, default='',
+                        help='File with the token to upload to the remote '
+                        'cache with (default: only read it)')
+    parser.add_argument('--cache-workers', type=int, default=16,
+                        help='Number of requests to the remote cache to '
+                        'send at once')
+    parser.add_argument('--scratch', type=str, default='auto',
+                        help='Where to put the scratch files of the external '
+                        'tools: auto (in {} when there is room, else on '
+                        'disk), disk, or a directory'.format(SHM_DIR))
+    parser.add_argument('--scratch-limit', type=int, default=256,
+                        help='MB that must be free in {} to use it for '
+                        'scratch files with --scratch auto'.format(SHM_DIR))
+    parser.add_argument('--scratch-share', type=int, default=1,
+                        help='Number of runs that use {} at once; each needs '
+                        '--scratch-limit MB of it'.format(SHM_DIR))
+    parser.add_argument('--shared-css', action='store_true',
+                        help='Use build-wide css class names')
+    parser.add_argument('--external-svg', action='store_true',
+                        help='Write displayed equations to separate svg files')
+    parser.add_argument('--font-format', default='woff',
+                        choices=sorted(FONT_FORMATS),
+                        help='Format of embedded fonts')
+    parser.add_argument('--subset-fonts', action='store_true',
+                        help='Remove unused glyphs and tables from fonts, and '
+                        'merge subsets of the same font')
+    parser.add_argument('--ff-workers', type=int, default=os.cpu_count(),
+                        help='Number of FontForge processes to run at once')
+    parser.add_argument('--ff-batch-size', type=int, default=20,
+                        help='Number of fonts to convert per FontForge call')
+    parser.add_argument('--stats', type=str, default='',
+                        help='Write timing statistics to this json file')
+    parser.add_argument('--trace', type=str, default='',
+                        help='Write trace events to this json file')
+    parser.add_argument('--trace-pid', type=int, default=0,
+                        help='Process id to use in trace events')
+    parser.add_argument('--record', type=str, default='',
+                        help='Save the output of external tools to this '
+                        'directory, for bench/replay.py')
+    parser.add_argument('--profile', type=str, default='',
+                        help='Write cProfile output to this file')
+    parser.add_argument('--memory', action='store_true',
+                        help='Record peak python memory use of each stage '
+                        '(slow)')
+    parser.add_argument('--mem-warn', type=int, default=0,
+                        help='Warn when a stage or an external tool uses '
+                        'more than this many megabytes')
+    parser.add_argument('--plan', type=str, default='',
+                        help='Only look up the files in the cache, and write '
+                        'the work to be done to this json file')
+    parser.add_argument('--progress-fd', type=int, default=-1,
+                        help='Write a line to this file descriptor for each '
+                        'finished file')
+    parser.add_argument('--server', type=str, default=DEFAULT_SERVER,
+                        help='Address of the render service to use if it is '
+                        'running (default: $PRETEX_SERVER or %(default)s)')
+    parser.add_argument('--server-timeout', type=float, default=600,
+                        help='Process the files here if the render service '
+                        'is silent for this many seconds')
+    parser.add_argument('--no-server', action='store_true',
+                        help='Do not use the render service')
     parser.add_argument('htmls', type=str, nargs='+',
                         help='HTML files to process')
-    args = parser.parse_args()
+    return parser.parse_args(argv)
 
+def server_token_file(address):
+    """
+    File with the token that the render service at address expects from its
+    clients; only readable by the user running it.
+    """
+    return os.path.join(os.path.expanduser('~'), '.pretex-server-{}'.format(
+        address.replace(':', '-')))
+
+def server_allows(args):
+    "Whether the render service runs processtex with these arguments."
+    defaults = vars(parse_args(['-']))
+    return all(val == defaults[name] for name, val in vars(args).items()
+               if name not in SERVER_OPTIONS)
+
+def run_on_server(address, argv, timeout):
+    """
+    Have the render service (server.py) process the files, if it is running.
+    Returns the exit status, or None if the service is not running or
+    failed.
+    """
+    url = 'http://{}/'.format(address)
+    try:
+        with open(server_token_file(address)) as fobj:
+            headers = {'X-Pretex-Token' : fobj.read().strip()}
+        with urlopen(Request(url + 'status', headers=headers), timeout=0.5):
+            pass
+    except (OSError, URLError):
+        return None
+    headers['Content-Type'] = 'application/json'
+    request = Request(url + 'process', data=json.dumps({
+        'argv' : argv,
+        'cwd'  : os.getcwd(),
+    }).encode(), headers=headers)
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            result = json.load(response)
+        status, output, progress \
+            = result['status'], result['output'], result['progress']
+    except (OSError, URLError, ValueError, KeyError) as exc:
+        log("The render service failed ({}), processing here".format(exc))
+        return None
+    sys.stdout.write(output)
+    if PROGRESS is not None:
+        PROGRESS.write(progress)
+    return status
+
+def main():
+    args = parse_args()
+    # pretex.py stops chunks with SIGTERM; clean up the scratch directory
+    signal.signal(signal.SIGTERM, lambda signum, _: sys.exit(128 + signum))
+    if args.progress_fd >= 0:
+        global PROGRESS
+        PROGRESS = os.fdopen(args.progress_fd, 'w', buffering=1)
+    if not args.no_server and server_allows(args):
+        status = run_on_server(args.server, sys.argv[1:],
+                               args.server_timeout)
+        if status is not None:
+            sys.exit(status)
+    run(args)
+
+def run(args):
+    "Process the files given by the command line arguments."
     with open(args.preamble) as fobj:
         preamble = fobj.read()
 
     if args.style_path:
         os.environ['TEXINPUTS'] = '.:{}:'.format(args.style_path)
     os.makedirs(args.cache_dir, exist_ok=True)
-
-    with TemporaryDirectory() as tmpdir:
+    args.cache = cachestore.open_cache(args.cache_dir, args.remote_cache,
+                                       args.cache_workers, log,
+                                       args.remote_cache_token)
+
+    if args.trace:
+        STATS.enable_trace(args.trace_pid)
+    STATS.enable_memory(args.memory, args.mem_warn, log)
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if args.plan:
+            plan_files(args, preamble)
+        else:
+            process_files(args, preamble)
+    except ToolError:
+        sys.exit(1)
+    finally:
+        # Wait for uploads to the remote cache
+        with STATS.stage('cache_upload'):
+            args.cache.close()
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.stats:
+            STATS.write(args.stats)
+        if args.trace:
+            STATS.write_trace(args.trace)
+
+def html_doc(args, html_file, preamble, tmpdir):
+    "HTMLDoc with the options given on the command line."
+    return HTMLDoc(html_file, preamble, tmpdir, args.cache_dir, args.img_dir,
+                   shared_css=args.shared_css,
+                   external_svg=args.external_svg,
+                   font_format=args.font_format,
+                   subset_fonts=args.subset_fonts,
+                   cache=args.cache,
+                   checkpoint_dir=None if args.no_checkpoint else
+                   os.path.join(args.cache_dir, 'checkpoints'),
+                   isolate_errors=args.isolate_errors)
+
+def plan_files(args, preamble):
+    """
+    Extract the code from the html files and look them up in the cache,
+    without running any external tool.  Writes a list with an entry per file
+    to args.plan.
+    """
+    plans = []
+    with TemporaryDirectory(
+            dir=scratch_dir(args.scratch, args.scratch_limit,
+                            args.scratch_share)) as tmpdir:
+        html_files = [html_doc(args, html_file, preamble, tmpdir)
+                      for html_file in args.htmls]
+        has_latex = [html.make_latex() for html in html_files]
+        cached = set()
+        if not args.no_cache:
+            cached = args.cache.exists(
+                [html.cache_name for html, has in zip(html_files, has_latex)
+                 if has])
+        for html, has in zip(html_files, has_latex):
+            plans.append({
+                'file'      : html.html_file,
+                'equations' : len(html.to_replace),
+                'cached'    : has and html.cache_name in cached,
+                # Identifies the snippets, to find duplicates across files
+                'snippets'  : [b64_hash(elt.attrib['type'] + elt.text.strip())
+                               for elt in html.to_replace],
+            })
+    with open(args.plan, 'w') as fobj:
+        json.dump(plans, fobj)
+
+def empty_dir(path):
+    "Make path an empty directory."
+    rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+def run_tools(html_files, tmpdir, ff_workers, ff_batch_size, inkscape=None,
+              font_dir=None):
+    """
+    Make the svgs and fonts of html files whose pdf files have been made, and
+    read in their extents.  Returns the set of html files for which a font
+    could not be converted.  The svgs are made by 'inkscape' (an
+    InkscapeShell), or else by INKSCAPE, or else by a new Inkscape.  The
+    fonts are made in 'font_dir', which is emptied first, or else in a
+    temporary directory.
+    """
+    if font_dir is None:
+        with TemporaryDirectory(dir=tmpdir) as font_dir:
+            return run_tools(html_files, tmpdir, ff_workers, ff_batch_size,
+                             inkscape, font_dir)
+    inkscape = inkscape or INKSCAPE
+    pdf_files = [html.pdf_file for html in html_files]
+    log("Adding unicode codepoints to fonts...")
+    # Add unicode codepoints to fonts in all pdf files
+    sfd_dir = os.path.join(font_dir, 'sfd')
+    empty_dir(sfd_dir)
+    with STATS.stage('tounicode'):
+        run_proc(['python2', TOUNICODE, '--outdir', sfd_dir] + pdf_files,
+                 'Could not add unicode codepoints to fonts')
+    # Now the extents are known; read in the pages
+    for html in html_files:
+        with STATS.stage('read_extents', html.html_file):
+            html.read_extents()
+        STATS.add('pages', html.num_pages, html.html_file)
+
+    # Convert all pages of all pdf files to svg files
+    log("Generating svg files...")
+    # inkscape exports images to the current directory
+    img_dir = os.path.join(tmpdir, 'img')
+    os.makedirs(img_dir, exist_ok=True)
+    # Files resumed from a checkpoint already have their svgs
+    script = ''.join(html.inkscape_script() for html in html_files
+                     if html.restored != 'svg')
+    if script:
+        with STATS.stage('inkscape'):
+            if inkscape is not None:
+                inkscape.run(script, img_dir)
+            else:
+                run_proc(['inkscape', '--shell'],
+                         "SVG conversion failed", script, cwd=img_dir)
+    for html in html_files:
+        html.checkpoint('svg')
+
+    # Convert all fonts.  This happens after generating the svgs so that
+    # unused glyphs can be removed.
+    log("Converting fonts to {} format...".format(
+        html_files[0].font_format))
+    woff_dir = os.path.join(font_dir, 'woff')
+    empty_dir(woff_dir)
+    with STATS.stage('fontforge'):
+        jobs = font_jobs(html_files, sfd_dir, woff_dir)
+        failed = convert_fonts(jobs, ff_workers, ff_batch_size)
+    STATS.add('fonts_converted', len(jobs))
+    STATS.add('fonts_shared', sum(len(job['users']) - 1 for job in jobs))
+    STATS.add('fonts_failed', len(failed))
+
+    # Associate the fonts with their html files
+    for job in jobs:
+        if job in failed:
+            continue
+        with open(job['out'], 'rb') as fobj:
+            data = fobj.read()
+        font_hash = 'f' + b64_hash(data)
+        for html, names in job['users']:
+            for name in names:
+                html.add_font(name, data, font_hash)
+    failed_htmls = set(html for job in failed for html, _ in job['users'])
+    for html in html_files:
+        if html not in failed_htmls:
+            html.checkpoint('fonts')
+    return failed_htmls
+
+def process_files(args, preamble):
+    "Run the whole pipeline on the html files given on the command line."
+    with TemporaryDirectory(
+            prefix='pretex-',
+            dir=scratch_dir(args.scratch, args.scratch_limit,
+                            args.scratch_share)) as tmpdir:
     #tmpdir = os.path.realpath('./tmp')
     #if True:
-        html_files = [HTMLDoc(html, preamble, tmpdir,
-                              args.cache_dir, args.img_dir)
-                      for html in args.htmls]
+        html_files = []
+        for html_file in args.htmls:
+            with STATS.stage('parse', html_file):
+                html_files.append(
+                    html_doc(args, html_file, preamble, tmpdir))
+        STATS.add('files', len(html_files))
 
         # Create pdf files
         log("Processing {} files".format(len(html_files)))
         log("Extracting code and running LaTeX...")
         done = set()
+        has_latex = {}
+        for html in html_files:
+            with STATS.stage('extract', html.html_file):
+                has_latex[html] = html.make_latex()
+        if not args.no_cache:
+            # Download the entries of all files at once from a remote cache
+            with STATS.stage('fetch_cache'):
+                args.cache.fetch([html.cache_name for html in html_files
+                                  if has_latex[html]])
         for html in html_files:
-            if not html.make_latex():
+            if not has_latex[html]:
                 # Nothing to TeX
+                STATS.add('no_math', 1, html.html_file)
                 done.add(html)
+                report_done(html)
                 continue
+            STATS.add('equations', len(html.to_replace), html.html_file)
             if html.is_cached and not args.no_cache:
-                html.use_cached(html.html_file)
+                with STATS.stage('use_cached', html.html_file):
+                    html.use_cached(html.html_file)
+                STATS.add('cache_hits', 1, html.html_file)
                 done.add(html)
+                report_done(html)
                 continue
             else:
+                STATS.add('cache_misses', 1, html.html_file)
+                if not args.no_cache and html.restore_checkpoint():
+                    log("Resuming {} after stage {}".format(
+                        os.path.basename(html.html_file), html.restored))
+                    STATS.add('resumed', 1, html.html_file)
+                    continue
                 log("(Re)processing {}".format(
                     os.path.basename(html.html_file)))
-                html.latex()
+                with STATS.stage('pdflatex', html.html_file):
+                    html.latex()
+                html.checkpoint('pdf')
         html_files = [h for h in html_files if h not in done]
         if not html_files:
             log("Done!")
             return
-        pdf_files = [html.pdf_file for html in html_files]
-        html_byhash = {html.basename : html for html in html_files}
-
-        log("Adding unicode codepoints to fonts...")
-        # Add unicode codepoints to fonts in all pdf files
-        sfd_dir = os.path.join(tmpdir, 'sfd')
-        os.makedirs(sfd_dir, exist_ok=True)
-        proc = Popen(['python2', TOUNICODE, '--outdir', sfd_dir] + pdf_files,
-                     stdout=PIPE, stderr=PIPE)
-        check_proc(proc, 'Could not add unicode codepoints to fonts')
-        # Now the extents are known; read in the pages
+        # Files with all stages checkpointed don't need the tools
+        todo = []
         for html in html_files:
-            html.read_extents()
-
-        # Convert all fonts
-        log("Converting fonts to woff format...")
-        woff_dir = os.path.join(tmpdir, 'woff')
-        os.makedirs(woff_dir, exist_ok=True)
-        script = []
-        for fname in os.listdir(sfd_dir):
-            if fname[-4:] != '.sfd':
-                continue
-            fullpath = os.path.join(sfd_dir, fname)
-            entry = ''
-            entry += 'Open("{}")\n'.format(fullpath)
-            entry += FIX_PRIVATE_TABLE
-            entry += 'Generate("{}")\n'.format(
-                os.path.join(woff_dir, fname[:-4] + '.woff'))
-            script.append(entry)
-            # Process 1000 at a time; otherwise ff might segfault
-            if len(script) == 1000:
-                proc = Popen([FONTFORGE, '-lang=ff', '-script', '-'],
-                             stdin=PIPE, stdout=PIPE, stderr=PIPE)
-                check_proc(proc, 'Could not convert pdf fonts to woff format',
-                           stdin=''.join(script))
-                script = []
-        proc = Popen([FONTFORGE, '-lang=ff', '-script', '-'],
-                     stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        check_proc(proc, 'Could not convert pdf fonts to woff format',
-                   stdin=''.join(script))
-
-        # Associate the fonts with their html filse
-        for fname in os.listdir(woff_dir):
-            match = re.match(r'\[(.*)\](.*)\.woff', fname)
-            if not match:
-                continue
-            hash_name, font_name = match.groups()
-            html_byhash[hash_name].add_font(
-                font_name.replace('+', ' '), os.path.join(woff_dir, fname))
-
-        # Convert all pages of all pdf files to svg files
-        log("Generating svg files...")
-        # inkscape exports images to the current directory
-        img_dir = os.path.join(tmpdir, 'img')
-        os.makedirs(img_dir, exist_ok=True)
-        script = ''.join(html.inkscape_script() for html in html_files)
-        proc = Popen(['inkscape', '--shell'],
-                     stdout=PIPE, stderr=PIPE, stdin=PIPE,
-                     cwd=img_dir)
-        check_proc(proc, "SVG conversion failed", script)
+            if html.restored == CHECKPOINT_STAGES[-1]:
+                with STATS.stage('read_extents', html.html_file):
+                    html.read_extents()
+                STATS.add('pages', html.num_pages, html.html_file)
+            else:
+                todo.append(html)
+        failed_htmls = set()
+        if todo:
+            failed_htmls = run_tools(todo, tmpdir, args.ff_workers,
+                                     args.ff_batch_size)
+        # Don't write html files with missing fonts, but finish the others
+        # so they are cached.
+        for html in failed_htmls:
+            log("Not writing {}: font conversion failed".format(
+                os.path.basename(html.html_file)))
+        html_files = [h for h in html_files if h not in failed_htmls]
+
+        if args.record:
+            log("Recording intermediate files...")
+            for html in html_files:
+                html.record(args.record)
 
         # Process svg files and write html
         log("Writing html files...")
         for html in html_files:
             html.write_html(html.html_file)
+            html.remove_checkpoint()
+            report_done(html)
+        if failed_htmls:
+            sys.exit(1)
         log("Done!")
 
 
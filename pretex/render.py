@@ -0,0 +1,186 @@
+#!env python3
+
+# Python interface to the renderer, for tools that want svgs for LaTeX snippets
+# without writing html files.
+#
+#     with Renderer(preamble) as renderer:
+#         results = renderer.render([('inline', r'x^2'),
+#                                    ('display', r'\[ \int f \]')])
+#         css = renderer.stylesheet(results)
+#
+# Each result is a dict with the html element to insert in a page ('element'),
+# the extents of the snippet, and the css rules and fonts the element uses.
+# The css class names only depend on the css values and the font names on the
+# font data (as with processtex --shared-css), so results of different calls
+# can be used on the same page.
+#
+# A Renderer keeps its scratch directories, a running "inkscape --shell" and an
+# in-memory cache of rendered snippets between calls, so only snippets it hasn't
+# seen before are sent through LaTeX, and Inkscape only starts once.  All new
+# snippets of a call are rendered in one batch.  pdflatex, tounicode.py and
+# FontForge are still run for each batch.  Close a Renderer (or use it as a
+# context manager) to stop Inkscape.
+
+import copy
+import os
+from collections import OrderedDict
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+
+import processtex
+
+
+# Snippet types, as in the type attribute text/x-latex-<type> of a <script>
+TYPES = ('inline', 'display', 'code', 'code-inline')
+
+
+class Renderer:
+    """
+    Renders batches of (type, code) snippets with a fixed preamble.
+    Snippets can include images from 'img_dir'.  The images of the results
+    are written to self.image_dir, and are referenced as
+    figure-images/<name> by the elements.  Pages are converted to svg by
+    'inkscape', a processtex.InkscapeShell that the caller closes, or else
+    by one of the Renderer's own.
+    """
+    def __init__(self, preamble, img_dir=None, font_format='woff',
+                 subset_fonts=False, ff_workers=None, ff_batch_size=20,
+                 cache_size=10000, inkscape=None):
+        self.preamble = preamble
+        self.font_format = font_format
+        self.subset_fonts = subset_fonts
+        self.ff_workers = ff_workers or os.cpu_count()
+        self.ff_batch_size = ff_batch_size
+        self.cache_size = cache_size
+        self._tmp = TemporaryDirectory(prefix='pretex-render-')
+        self.tmp_dir = self._tmp.name
+        self.image_dir = os.path.join(self.tmp_dir, 'images')
+        os.makedirs(self.image_dir)
+        if img_dir is None:
+            img_dir = os.path.join(self.tmp_dir, 'include')
+            os.makedirs(img_dir)
+        self.img_dir = img_dir
+        # Reused for the sfd and font files of each batch
+        self.font_dir = os.path.join(self.tmp_dir, 'fonts')
+        self.own_inkscape = inkscape is None
+        if inkscape is None:
+            inkscape = processtex.InkscapeShell(
+                os.path.join(self.tmp_dir, 'inkscape'))
+        self.inkscape = inkscape
+        # Results by (type, code), least recently used first
+        self.cache = OrderedDict()
+        self.style = None
+        self.batches = 0
+
+    def close(self):
+        "Stop Inkscape and remove the scratch files."
+        if self.own_inkscape:
+            self.inkscape.close()
+        self._tmp.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def render(self, snippets):
+        """
+        Render a list of (type, code) pairs.  Returns a result for each, in
+        order.  Raises processtex.ToolError if LaTeX or another tool fails.
+        """
+        keys = []
+        for typ, code in snippets:
+            if typ not in TYPES:
+                raise ValueError("Unknown snippet type: {}".format(typ))
+            # Snippets are rendered from <script> elements, which make_latex()
+            # skips when empty
+            if not code.strip():
+                raise ValueError("Empty snippet")
+            if '</script' in code.lower():
+                raise ValueError("Snippet contains '</script'")
+            keys.append((typ, code.strip()))
+        todo = [key for key in OrderedDict.fromkeys(keys)
+                if key not in self.cache]
+        if todo:
+            self._render(todo)
+        results = []
+        for key in keys:
+            self.cache.move_to_end(key)
+            result = dict(self.cache[key])
+            # lxml elements can only have one parent
+            result['element'] = copy.deepcopy(result['element'])
+            results.append(result)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return results
+
+    def stylesheet(self, results):
+        "The css for a list of results: pretex styles, fonts and classes."
+        faces = {}
+        rules = {}
+        for result in results:
+            faces.update(result['fonts'])
+            rules.update(result['css'])
+        return ((self.style or '')
+                + processtex.font_face_css(faces, self.font_format)
+                + ''.join('{} {{ {} }}\n'.format(selector, val)
+                          for selector, val in sorted(rules.items())))
+
+    def _render(self, keys):
+        "Render snippets that are not in the cache."
+        self.batches += 1
+        body = ''.join('<script type="text/x-latex-{}">{}</script>\n'.format(
+            typ, code) for typ, code in keys)
+        doc = processtex.HTMLDoc(
+            '<batch {}>'.format(self.batches), self.preamble, self.tmp_dir,
+            self.image_dir, self.img_dir, shared_css=True,
+            font_format=self.font_format, subset_fonts=self.subset_fonts,
+            html_data='<html><body>{}</body></html>'.format(body))
+        try:
+            doc.make_latex()
+            if len(doc.to_replace) != len(keys):
+                raise processtex.ToolError(
+                    "Rendering {} snippets, found {}".format(
+                        len(keys), len(doc.to_replace)))
+            doc.latex()
+            if processtex.run_tools([doc], self.tmp_dir, self.ff_workers,
+                                    self.ff_batch_size, self.inkscape,
+                                    self.font_dir):
+                raise processtex.ToolError("Font conversion failed")
+            svgs = doc.process_svgs()
+        finally:
+            rmtree(doc.base_dir, ignore_errors=True)
+        self.style = doc.page_style()
+        faces = doc.font_faces()
+        for key, svg, extents in zip(keys, svgs, doc.pages_extents):
+            css, fonts = self._used_css(doc, svg, faces)
+            self.cache[key] = {
+                'type'    : key[0],
+                'code'    : key[1],
+                'element' : svg,
+                'extents' : extents,
+                'css'     : css,
+                'fonts'   : fonts,
+            }
+
+    @staticmethod
+    def _used_css(doc, svg, faces):
+        "The class rules and fonts used by an element."
+        used = set()
+        for elt in svg.iter():
+            used.update(elt.attrib.get('class', '').split())
+        css = {}
+        fonts = {}
+        for kind, classes in (('tspan', doc.tspan_classes),
+                              ('path', doc.path_classes)):
+            for name, val in classes.class_names.items():
+                if name not in used:
+                    continue
+                css['svg.pretex {}.{}'.format(kind, name)] = val
+                for item in val.split(';'):
+                    if item.startswith('font-family:'):
+                        font_hash = item[len('font-family:'):]
+                        if font_hash in faces:
+                            fonts[font_hash] = faces[font_hash]
+        return css, fonts
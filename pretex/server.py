@@ -0,0 +1,268 @@
+#!env python3
+
+# Long-running render service.
+#
+# Starting processtex.py costs more than rendering a page of a book: python
+# and lxml have to be loaded, and Inkscape has to start.  This service saves
+# those costs: it keeps the python modules loaded and one Inkscape shell
+# running, which converts the pages of every request, and keeps a Renderer
+# (see render.py) with its snippet cache for each preamble.  Of the external
+# tools, only Inkscape stays running: pdflatex, tounicode.py and FontForge are
+# started for each request, as in a local run.
+#
+# It listens on localhost over http:
+#
+#     GET  /status   Uptime and request counts.
+#     POST /process  {"argv": [...], "cwd": "..."}: run processtex with these
+#                    command line arguments.  processtex.py does this by
+#                    itself when the service is running, unless --no-server
+#                    or an option outside processtex.SERVER_OPTIONS is used.
+#     POST /render   {"preamble": "...", "snippets": [[type, code], ...]}:
+#                    render snippets; returns the html of each and the css.
+#
+# Requests must send the token the service writes to a file only its user can
+# read (see processtex.server_token_file()) in an X-Pretex-Token header, with
+# the address of the service as Host, and POST requests must be json.  Other
+# local users and web pages in a browser can't run processtex.
+#
+# Requests are handled one at a time.
+
+import argparse
+import hmac
+import json
+import os
+import secrets
+import signal
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from tempfile import TemporaryDirectory
+
+from lxml import html
+
+import processtex
+import render
+import stats
+
+
+class RequestError(Exception):
+    "A request that can't be handled, with the http status to reply with."
+
+    def __init__(self, code, msg):
+        super().__init__(msg)
+        self.code = code
+
+
+class Service:
+    "The state kept between requests."
+
+    def __init__(self, work_dir, max_renderers=4):
+        self.work_dir = work_dir
+        self.max_renderers = max_renderers
+        self.lock = threading.Lock()
+        # Renderers by preamble, least recently used first
+        self.renderers = OrderedDict()
+        self.start = time.time()
+        self.requests = {'process' : 0, 'render' : 0}
+        processtex.INKSCAPE = processtex.InkscapeShell(
+            os.path.join(work_dir, 'inkscape'))
+
+    def close(self):
+        processtex.INKSCAPE.close()
+        for renderer in self.renderers.values():
+            renderer.close()
+
+    def status(self):
+        return {
+            'pid'       : os.getpid(),
+            'uptime'    : time.time() - self.start,
+            'requests'  : self.requests,
+            'renderers' : len(self.renderers),
+            'snippets'  : sum(len(renderer.cache)
+                              for renderer in self.renderers.values()),
+        }
+
+    def process(self, request):
+        "Run processtex on the command line arguments of a client."
+        try:
+            args = processtex.parse_args(request['argv'])
+        except SystemExit:
+            raise RequestError(400, 'Bad arguments')
+        if not processtex.server_allows(args):
+            raise RequestError(403, 'Options not allowed')
+        out = StringIO()
+        environ = dict(os.environ)
+        cwd = os.getcwd()
+        with self.lock:
+            self.requests['process'] += 1
+            processtex.STATS = stats.Stats()
+            processtex.PROGRESS = StringIO()
+            try:
+                os.chdir(request['cwd'])
+                with redirect_stdout(out):
+                    processtex.run(args)
+                status = 0
+            except SystemExit as exc:
+                status = exc.code if isinstance(exc.code, int) else 1
+            except Exception:
+                out.write(traceback.format_exc())
+                status = 1
+            finally:
+                os.chdir(cwd)
+                os.environ.clear()
+                os.environ.update(environ)
+                if tracemalloc.is_tracing():
+                    tracemalloc.stop()
+            progress = processtex.PROGRESS.getvalue()
+            processtex.PROGRESS = None
+        return {'status'   : status,
+                'output'   : out.getvalue(),
+                'progress' : progress}
+
+    def render(self, request):
+        "Render a batch of snippets."
+        preamble = request['preamble']
+        with self.lock:
+            self.requests['render'] += 1
+            # Nobody reads the statistics of renders; don't keep them
+            processtex.STATS = stats.Stats()
+            if preamble not in self.renderers:
+                self.renderers[preamble] = render.Renderer(
+                    preamble, inkscape=processtex.INKSCAPE)
+                while len(self.renderers) > self.max_renderers:
+                    self.renderers.popitem(last=False)[1].close()
+            self.renderers.move_to_end(preamble)
+            renderer = self.renderers[preamble]
+            out = StringIO()
+            try:
+                with redirect_stdout(out):
+                    results = renderer.render(
+                        [tuple(snippet) for snippet in request['snippets']])
+            except processtex.ToolError as exc:
+                return {'error' : str(exc), 'output' : out.getvalue()}
+            except Exception:
+                return {'error'  : traceback.format_exc(),
+                        'output' : out.getvalue()}
+            return {
+                'results' : [{
+                    'html'    : html.tostring(result['element'],
+                                              encoding='unicode'),
+                    'extents' : result['extents'],
+                } for result in results],
+                'css'     : renderer.stylesheet(results),
+            }
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Dispatches requests to the Service in self.server.service, from clients
+    with self.server.token.
+    """
+
+    def _reply(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _allowed(self):
+        "Check the Host and the token of a request, replying if they're bad."
+        if self.headers.get('Host') not in self.server.hosts:
+            self._reply(403, {'error' : 'Bad host'})
+            return False
+        token = self.headers.get('X-Pretex-Token', '')
+        if not hmac.compare_digest(token.encode(),
+                                   self.server.token.encode()):
+            self._reply(403, {'error' : 'Bad token'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._allowed():
+            return
+        if self.path == '/status':
+            self._reply(200, self.server.service.status())
+        else:
+            self._reply(404, {'error' : 'Not found'})
+
+    def do_POST(self):
+        methods = {'/process' : self.server.service.process,
+                   '/render'  : self.server.service.render}
+        if not self._allowed():
+            return
+        if self.path not in methods:
+            self._reply(404, {'error' : 'Not found'})
+            return
+        if self.headers.get_content_type() != 'application/json':
+            self._reply(415, {'error' : 'Expected application/json'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            self._reply(200, methods[self.path](request))
+        except (ValueError, KeyError, TypeError):
+            self._reply(400, {'error' : 'Bad request'})
+        except RequestError as exc:
+            self._reply(exc.code, {'error' : str(exc)})
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+
+def write_token(fname):
+    "Write a new token to a file only this user can read; returns it."
+    token = secrets.token_hex(16)
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as fobj:
+        fobj.write(token)
+    return token
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve processtex and snippet rendering requests.')
+    parser.add_argument('--address', type=str,
+                        default=processtex.DEFAULT_SERVER,
+                        help='host:port to listen on (default: '
+                        '$PRETEX_SERVER or %(default)s)')
+    parser.add_argument('--renderers', type=int, default=4,
+                        help='Number of preambles to keep renderers for')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log requests')
+    args = parser.parse_args()
+
+    # Remove the token file when stopped
+    signal.signal(signal.SIGTERM, lambda signum, _: sys.exit(128 + signum))
+    host, port = args.address.rsplit(':', 1)
+    token_file = processtex.server_token_file(args.address)
+    with TemporaryDirectory(prefix='pretex-server-') as work_dir:
+        server = ThreadingHTTPServer((host, int(port)), Handler)
+        server.service = Service(work_dir, args.renderers)
+        server.verbose = args.verbose
+        server.token = write_token(token_file)
+        # Names of this server in the Host header; anything else could be a
+        # DNS rebinding attack from a web page
+        server.hosts = set([args.address] + [
+            '{}:{}'.format(name, port)
+            for name in ('localhost', '127.0.0.1', '[::1]')])
+        print("Serving on {}".format(args.address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            server.service.close()
+            os.remove(token_file)
+
+if __name__ == '__main__':
+    main()
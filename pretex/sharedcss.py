@@ -0,0 +1,145 @@
+#!env python3
+
+# Build-wide css class registry.
+#
+# With --shared-css, processtex names the tspan and path css classes by a hash
+# of their value instead of by order of appearance, so the names agree across
+# all pages of the book.  These placeholder names are long; once every page
+# has been processed, finalize() counts how often each one is used, gives the
+# shortest names to the most frequent values, moves the rules into a single
+# stylesheet, and links that stylesheet from each page.
+#
+# Every page links the stylesheet, including the ones without math: knowls are
+# loaded into the page they are opened from, and their own link is relative to
+# the knowl directory, so they use the rules linked by that page.
+#
+# The short names are kept in a registry next to the stylesheet, which is only
+# added to: when some of the pages are processed again (by pretex.py --watch,
+# or a build in which the other pages were already done), the pages that
+# aren't keep using the same stylesheet.  New classes get the next names.
+
+import json
+import os
+import re
+from base64 import b64encode
+from hashlib import md5
+
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+PLACEHOLDER_PREFIX = 'pretex-c'
+PLACEHOLDER_RE = re.compile(re.escape(PLACEHOLDER_PREFIX) + r'[-\w]{12}')
+
+# Rules as written by CSSClasses.css() in processtex
+RULE_RE = re.compile(r'^(svg\.pretex (?:tspan|path))\.('
+                     + PLACEHOLDER_RE.pattern + r') \{ (.*) \}\n', re.M)
+
+CLASS_ATTR_RE = re.compile(r'class="([^"]*)"')
+
+# The link to the stylesheet added by finalize()
+LINK_RE = re.compile(r'<link id="pretex-classes" [^>]*>\n?')
+
+
+def short_name(number):
+    "Convert a number to a short css class name."
+    if 0 <= number < len(ALPHABET):
+        return ALPHABET[number]
+    text = ''
+    while number != 0:
+        number, i = divmod(number, len(ALPHABET))
+        text = ALPHABET[i] + text
+    return text
+
+def placeholder(val):
+    "Page-independent class name for a css value."
+    digest = md5(val.encode()).digest()[:9]
+    return PLACEHOLDER_PREFIX + b64encode(digest, b'-_').decode('ascii')
+
+def registry_file(css_file):
+    "Where the short names of the classes in css_file are kept."
+    return os.path.splitext(css_file)[0] + '-names.json'
+
+def load_registry(css_file):
+    "The registry of css_file: [placeholder, short name, selector, value]s."
+    try:
+        with open(registry_file(css_file), encoding='utf-8') as fobj:
+            return json.load(fobj)
+    except FileNotFoundError:
+        return []
+
+def finalize(html_files, css_file, sizes=None):
+    """
+    Replace placeholder class names in html_files by short names, write
+    the corresponding rules to css_file, and link it from each of the files.
+    Returns the number of classes.  If 'sizes' is a dict, the changes of the
+    bytes_* sizes of each file (see processtex HTMLDoc._write_dom()) are put
+    in it by file name.
+    """
+    registry = load_registry(css_file)
+    names = {entry[0] : entry[1] for entry in registry}
+    rules = {}
+    counts = {}
+    for html_file in html_files:
+        with open(html_file, encoding='utf-8') as fobj:
+            text = fobj.read()
+        for selector, name, val in RULE_RE.findall(text):
+            rules[name] = (selector, val)
+        for classes in CLASS_ATTR_RE.findall(text):
+            for name in PLACEHOLDER_RE.findall(classes):
+                counts[name] = counts.get(name, 0) + 1
+    if not rules and not registry:
+        return 0
+
+    # Most frequently used new classes get the shortest names left
+    new = sorted((name for name in rules if name not in names),
+                 key=lambda name: (-counts.get(name, 0), name))
+    for name in new:
+        names[name] = short_name(len(registry))
+        registry.append([name, names[name]] + list(rules[name]))
+    if new:
+        tmp_file = registry_file(css_file) + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as fobj:
+            json.dump(registry, fobj)
+        os.replace(tmp_file, registry_file(css_file))
+
+    css = ''.join('{}.{} {{ {} }}\n'.format(selector, short, val)
+                  for _, short, selector, val in registry)
+    with open(css_file, 'w', encoding='utf-8') as fobj:
+        fobj.write(css)
+    # The query string changes whenever the stylesheet does, so browsers can
+    # cache it indefinitely.
+    version = md5(css.encode()).hexdigest()[:10]
+
+    for html_file in html_files:
+        with open(html_file, encoding='utf-8') as fobj:
+            old_text = fobj.read()
+        # Also replaces links to older versions of the stylesheet
+        text = LINK_RE.sub('', old_text)
+        classes = svg = 0
+        if PLACEHOLDER_PREFIX in text:
+            size = len(text.encode())
+            text = RULE_RE.sub('', text)
+            classes = len(text.encode()) - size
+            size = len(text.encode())
+            # Class names are only used in the svgs
+            text = PLACEHOLDER_RE.sub(
+                lambda m: names.get(m.group(0), m.group(0)), text)
+            svg = len(text.encode()) - size
+        idx = text.find('</head>')
+        if idx != -1:
+            href = os.path.relpath(css_file, os.path.dirname(html_file))
+            link = '<link id="pretex-classes" rel="stylesheet" ' \
+                   'href="{}?v={}">\n'.format(href.replace(os.sep, '/'),
+                                                version)
+            text = text[:idx] + link + text[idx:]
+        if text != old_text:
+            with open(html_file, 'w', encoding='utf-8') as fobj:
+                fobj.write(text)
+        if sizes is not None:
+            sizes[html_file] = {
+                'bytes_classes' : classes,
+                'bytes_svg'     : svg,
+                'bytes_html'    : (len(text.encode()) - len(old_text.encode())
+                                   - classes - svg),
+            }
+    return len(registry)
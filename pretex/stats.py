@@ -0,0 +1,477 @@
+#!env python3
+
+# Performance statistics for processtex runs.
+#
+# Each processtex run records, for each stage of the pipeline and for each
+# html file, the wall time, the cpu time (including that of external tools),
+# and some item counts.  The reports of all chunks of a build are merged by
+# pretex.py into one build-level summary.
+#
+# Optionally the stages and external processes are also recorded as events in
+# the Trace Event Format, which can be loaded into chrome://tracing or
+# Perfetto.  cProfile output of the processtex runs can also be merged.
+#
+# With --plan, the work of a build is estimated from the cache lookups of the
+# processtex runs and the timings of a previous build.
+#
+# The bytes of each output page are counted by origin, for the size report of
+# pretex.py --size-report.
+#
+# Memory use is recorded as the resident set size of processtex at the end of
+# each stage, the peak python allocations during each stage (with tracemalloc,
+# if enabled), and the peak resident set size of each external tool.
+
+import json
+import os
+import pstats
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from io import StringIO
+
+
+REPORT_VERSION = 1
+
+
+def cpu_time():
+    "CPU time used by this process and its terminated children."
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+def maxrss_kb(rusage):
+    "Peak resident set size from a struct rusage, in kilobytes."
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss // 1024
+    return rusage.ru_maxrss
+
+def rss_kb():
+    "Current resident set size of this process, in kilobytes."
+    try:
+        with open('/proc/self/statm') as fobj:
+            pages = int(fobj.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (OSError, IndexError, ValueError):
+        return maxrss_kb(resource.getrusage(resource.RUSAGE_SELF))
+
+def trace_event(name, cat, start, dur, pid, tid, args=None):
+    "A complete ('X') trace event; times are in seconds since the epoch."
+    return {
+        'name' : name,
+        'cat'  : cat,
+        'ph'   : 'X',
+        'ts'   : int(start * 1e6),
+        'dur'  : int(dur * 1e6),
+        'pid'  : pid,
+        'tid'  : tid,
+        'args' : args or {},
+    }
+
+def write_trace(events, fname):
+    with open(fname, 'w') as fobj:
+        json.dump(events, fobj)
+
+def process_name(pid, name):
+    "Trace metadata event naming a process track."
+    return {'name' : 'process_name', 'ph' : 'M', 'pid' : pid,
+            'args' : {'name' : name}}
+
+def merge_traces(fnames, events, out_file):
+    "Concatenate the events in trace files to 'events' and write out_file."
+    events = list(events)
+    for fname in fnames:
+        if not os.path.exists(fname):
+            continue
+        with open(fname) as fobj:
+            events += json.load(fobj)
+    with open(out_file, 'w') as fobj:
+        json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, fobj)
+
+def _add_time(record, name, wall, cpu, memory):
+    entry = record.setdefault(name, {'wall' : 0.0, 'cpu' : 0.0, 'calls' : 0})
+    entry['wall'] += wall
+    entry['cpu'] += cpu
+    entry['calls'] += 1
+    for key, val in memory.items():
+        entry[key] = max(entry.get(key, 0), val)
+
+# Memory entries of stages and processes, which are merged by taking maxima
+MEMORY_KEYS = ('rss_kb', 'py_peak_kb', 'max_rss_kb')
+
+
+class Popen(subprocess.Popen):
+    """
+    Popen that keeps the resource usage of the child process, as returned by
+    wait4(), in the 'rusage' attribute once the child has been waited for
+    without a timeout (as communicate() and wait() do).
+    """
+    rusage = None
+
+    def wait(self, timeout=None):
+        if timeout is not None or self.returncode is not None:
+            return super().wait(timeout)
+        try:
+            _, status, self.rusage = os.wait4(self.pid, 0)
+        except ChildProcessError:
+            # Already reaped elsewhere; Popen.wait() handles that
+            return super().wait()
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+    def describe_exit(self):
+        "Explain a failed exit, including memory use if it was killed."
+        if self.returncode is None:
+            return 'still running'
+        if self.returncode >= 0:
+            return 'exit status {}'.format(self.returncode)
+        text = 'killed by signal {}'.format(-self.returncode)
+        if self.rusage is not None:
+            text += ' after using {} MB'.format(
+                maxrss_kb(self.rusage) // 1024)
+        return text
+
+
+class Stats:
+    """
+    Collects timings and counts for one processtex run.  Stage and counter
+    names are free-form; per-file data is keyed by the html file name.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.stages = {}
+        self.counts = {}
+        self.docs = {}
+        # Trace events, if tracing
+        self.events = None
+        self.trace_pid = os.getpid()
+        self._tids = {}
+        # Peak memory of external tools, by name
+        self.processes = {}
+        self.mem_warn_kb = 0
+        self.warn = print
+        # FontForge runs are recorded from the threads of convert_fonts()
+        self.lock = threading.Lock()
+
+    def enable_trace(self, pid=None):
+        "Record trace events, on the track of process 'pid'."
+        self.events = []
+        if pid:
+            self.trace_pid = pid
+
+    def enable_memory(self, trace_malloc=False, warn_mb=0, warn=print):
+        """
+        Record peak python allocations per stage if trace_malloc (this slows
+        python down), and call warn() when a stage or an external tool uses
+        more than warn_mb megabytes.
+        """
+        if trace_malloc:
+            tracemalloc.start()
+        self.mem_warn_kb = warn_mb * 1024
+        self.warn = warn
+
+    def _check_memory(self, what, kb):
+        if self.mem_warn_kb and kb > self.mem_warn_kb:
+            self.warn("WARNING: {} used {} MB of memory".format(
+                what, kb // 1024))
+
+    def _trace(self, name, cat, start, dur, args):
+        if self.events is None:
+            return
+        with self.lock:
+            # Threads get small track numbers in order of appearance
+            tid = self._tids.setdefault(threading.get_ident(),
+                                        len(self._tids))
+            self.events.append(trace_event(
+                name, cat, start, dur, self.trace_pid, tid, args))
+
+    def doc(self, name):
+        return self.docs.setdefault(name, {'stages' : {}, 'counts' : {}})
+
+    @contextmanager
+    def stage(self, name, doc=None):
+        "Time the enclosed code as the stage 'name'."
+        start = time.time()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = cpu_time() - cpu
+            memory = {'rss_kb' : rss_kb()}
+            if tracemalloc.is_tracing():
+                peak = tracemalloc.get_traced_memory()[1]
+                memory['py_peak_kb'] = peak // 1024
+            _add_time(self.stages, name, wall, cpu, memory)
+            if doc is not None:
+                _add_time(self.doc(doc)['stages'], name, wall, cpu, memory)
+            self._check_memory('stage {}'.format(name), max(memory.values()))
+            self._trace(name, 'stage', start, wall,
+                        {'file' : doc} if doc is not None else None)
+            if self.events is not None:
+                self.events.append({
+                    'name' : 'memory', 'ph' : 'C', 'pid' : self.trace_pid,
+                    'ts'   : int((start + wall) * 1e6),
+                    'args' : {'rss_mb' : memory['rss_kb'] / 1024}})
+
+    @contextmanager
+    def span(self, name, cat='proc', **args):
+        "Record the enclosed code in the trace only."
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._trace(name, cat, start, time.time() - start, args)
+
+    def add_process(self, name, proc):
+        "Record the memory and cpu use of a finished stats.Popen process."
+        if proc.rusage is None:
+            return
+        kb = maxrss_kb(proc.rusage)
+        with self.lock:
+            entry = self.processes.setdefault(
+                name, {'calls' : 0, 'cpu' : 0.0, 'max_rss_kb' : 0})
+            entry['calls'] += 1
+            entry['cpu'] += proc.rusage.ru_utime + proc.rusage.ru_stime
+            entry['max_rss_kb'] = max(entry['max_rss_kb'], kb)
+        self._check_memory(name, kb)
+
+    def add(self, name, num=1, doc=None):
+        "Increment a counter."
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + num
+            if doc is not None:
+                counts = self.doc(doc)['counts']
+                counts[name] = counts.get(name, 0) + num
+
+    def report(self):
+        processes = dict(self.processes)
+        processes['processtex'] = {
+            'calls'      : 1,
+            'cpu'        : time.process_time(),
+            'max_rss_kb' : maxrss_kb(resource.getrusage(resource.RUSAGE_SELF)),
+        }
+        return {
+            'version'   : REPORT_VERSION,
+            'pid'       : os.getpid(),
+            'start'     : self.start,
+            'wall'      : time.time() - self.start,
+            'stages'    : self.stages,
+            'counts'    : self.counts,
+            'processes' : processes,
+            'docs'      : [dict(file=name, **data)
+                           for name, data in sorted(self.docs.items())],
+        }
+
+    def write(self, fname):
+        with open(fname, 'w') as fobj:
+            json.dump(self.report(), fobj, indent=1, sort_keys=True)
+
+    def write_trace(self, fname):
+        write_trace(self.events or [], fname)
+
+
+def merge(reports, wall):
+    "Merge per-run reports into one build report; wall is the build time."
+    stages = {}
+    counts = {}
+    processes = {}
+    docs = []
+    for report in reports:
+        for merged, entries in ((stages, report['stages']),
+                                (processes, report.get('processes', {}))):
+            for name, entry in entries.items():
+                total = merged.setdefault(name, {})
+                for key, val in entry.items():
+                    if key in MEMORY_KEYS:
+                        total[key] = max(total.get(key, 0), val)
+                    else:
+                        total[key] = total.get(key, 0) + val
+        for name, num in report['counts'].items():
+            counts[name] = counts.get(name, 0) + num
+        docs += report['docs']
+    equations = counts.get('equations', 0)
+    for entry in stages.values():
+        entry['per_equation'] = entry['wall'] / equations if equations else 0
+    return {
+        'version'    : REPORT_VERSION,
+        'wall'       : wall,
+        'runs'       : len(reports),
+        'stages'     : stages,
+        'counts'     : counts,
+        'processes'  : processes,
+        'throughput' : {
+            'files_per_sec'     : counts.get('files', 0) / wall if wall else 0,
+            'equations_per_sec' : equations / wall if wall else 0,
+        },
+        'docs'       : sorted(docs, key=lambda doc: doc['file']),
+    }
+
+# Seconds per file, per equation of a cached file and per equation of a file
+# that has to be processed, when there is no previous build to go by
+DEFAULT_RATES = {'file' : 0.02, 'cached' : 0.002, 'uncached' : 0.05}
+
+# Stages that are run for every file, and for cached files only
+FILE_STAGES = ('parse', 'extract', 'fetch_cache')
+CACHED_STAGES = ('use_cached',)
+
+def stage_kind(name):
+    "What the time of a stage is proportional to: a key of work_units()."
+    if name in FILE_STAGES:
+        return 'file'
+    if name in CACHED_STAGES:
+        return 'cached'
+    return 'uncached'
+
+def work_units(report):
+    """
+    Number of files, equations in cached files and equations in processed
+    files in a build report written by merge().
+    """
+    units = {'file' : report['counts'].get('files', 0),
+             'cached' : 0, 'uncached' : 0}
+    for doc in report['docs']:
+        counts = doc['counts']
+        if counts.get('cache_hits'):
+            units['cached'] += counts.get('equations', 0)
+        elif counts.get('cache_misses'):
+            units['uncached'] += counts.get('equations', 0)
+    return units
+
+def work_rates(report, defaults=DEFAULT_RATES):
+    """
+    Seconds of work per file and per equation, from a build report written by
+    merge().  Returns the defaults where the report has no data.
+    """
+    result = dict(defaults)
+    if not report:
+        return result
+    times = {'file' : 0.0, 'cached' : 0.0, 'uncached' : 0.0}
+    for name, entry in report['stages'].items():
+        times[stage_kind(name)] += entry['wall']
+    for key, num in work_units(report).items():
+        if num:
+            result[key] = times[key] / num
+    return result
+
+def plan(plans, rates, workers):
+    """
+    Summarize the per-file plans written by processtex --plan, and estimate
+    the wall time of the build on 'workers' parallel processes.
+    """
+    summary = {
+        'files'              : len(plans),
+        'files_with_math'    : 0,
+        'cache_hits'         : 0,
+        'cache_misses'       : 0,
+        'equations'          : 0,
+        'equations_uncached' : 0,
+        'snippets_unique'    : 0,
+        'snippets_duplicate' : 0,
+        'snippets_uncached'  : 0,
+    }
+    seen = set()
+    uncached = set()
+    for entry in plans:
+        summary['equations'] += entry['equations']
+        if not entry['equations']:
+            continue
+        summary['files_with_math'] += 1
+        if entry['cached']:
+            summary['cache_hits'] += 1
+        else:
+            summary['cache_misses'] += 1
+            summary['equations_uncached'] += entry['equations']
+            uncached.update(entry['snippets'])
+        for snippet in entry['snippets']:
+            if snippet in seen:
+                summary['snippets_duplicate'] += 1
+            seen.add(snippet)
+    summary['snippets_unique'] = len(seen)
+    summary['snippets_uncached'] = len(uncached)
+    work = (rates['file'] * summary['files']
+            + rates['cached'] * (summary['equations']
+                                 - summary['equations_uncached'])
+            + rates['uncached'] * summary['equations_uncached'])
+    summary['estimated_work'] = work
+    summary['estimated_wall'] = work / max(workers, 1)
+    return summary
+
+# Parts of an output page, as counted by processtex
+SIZE_KEYS = ('bytes_html', 'bytes_svg', 'bytes_fonts', 'bytes_css',
+             'bytes_classes')
+
+def page_sizes(report, budget=0):
+    """
+    Size report of the pages in a build report written by merge(), largest
+    pages first.  The total is the size of the file as it is now.
+    """
+    pages = []
+    totals = {key : 0 for key in SIZE_KEYS + ('total',)}
+    for doc in report['docs']:
+        counts = doc['counts']
+        if 'bytes_written' not in counts or not os.path.exists(doc['file']):
+            continue
+        page = {key : counts.get(key, 0) for key in SIZE_KEYS}
+        page['total'] = os.path.getsize(doc['file'])
+        for key, val in page.items():
+            totals[key] += val
+        page['file'] = doc['file']
+        pages.append(page)
+    pages.sort(key=lambda page: (-page['total'], page['file']))
+    return {
+        'budget'      : budget,
+        'totals'      : totals,
+        'over_budget' : [page['file'] for page in pages
+                         if budget and page['total'] > budget],
+        'pages'       : pages,
+    }
+
+def add_sizes(report, changes):
+    """
+    Add changes of the bytes_* sizes of pages made after the build, by file
+    name, to a report written by merge().
+    """
+    for doc in report['docs']:
+        for key, num in changes.get(doc['file'], {}).items():
+            doc['counts'][key] = doc['counts'].get(key, 0) + num
+            report['counts'][key] = report['counts'].get(key, 0) + num
+
+def read_reports(fnames):
+    "Read the reports that exist among fnames."
+    reports = []
+    for fname in fnames:
+        if not os.path.exists(fname):
+            continue
+        with open(fname) as fobj:
+            reports.append(json.load(fobj))
+    return reports
+
+def merge_profiles(fnames, out_dir, num_lines=40):
+    """
+    Merge cProfile output files into out_dir/merged.prof, and write a report
+    of the hottest functions to out_dir/report.txt.  Returns the report.
+    """
+    fnames = [fname for fname in fnames if os.path.exists(fname)]
+    if not fnames:
+        return ''
+    merged = pstats.Stats(*fnames)
+    merged.dump_stats(os.path.join(out_dir, 'merged.prof'))
+    out = StringIO()
+    merged.stream = out
+    out.write('Merged {} profiles\n\n'.format(len(fnames)))
+    merged.strip_dirs()
+    for key in ('tottime', 'cumulative'):
+        out.write('*** Sorted by {} ***\n'.format(key))
+        merged.sort_stats(key).print_stats(num_lines)
+    report = out.getvalue()
+    with open(os.path.join(out_dir, 'report.txt'), 'w') as fobj:
+        fobj.write(report)
+    return report
@@ -8,9 +8,11 @@
 # rendered content in the output pdf.
 
 import argparse
+import json
 import os
 import sys
 import unicodedata
+from hashlib import md5
 
 import platform
 if platform.system() == 'Darwin':
@@ -89,6 +91,15 @@ def generate_tounicode(font, pdffont):
             'end\n')
     return out
 
+def font_program(pdffont):
+    "Return the raw embedded font program of a pdf font, or None."
+    desc = pdffont.FontDescriptor
+    for key in ('FontFile', 'FontFile2', 'FontFile3'):
+        fontfile = getattr(desc, key, None)
+        if fontfile is not None and fontfile.stream is not None:
+            return fontfile.stream
+    return None
+
 def main():
     parser = argparse.ArgumentParser(
         description='Add ToUnicode tables to PDF files.')
@@ -98,7 +109,12 @@ def main():
                         help='PDF files to process')
     args = parser.parse_args()
 
-    fontnum = 0
+    # Describes the saved fonts for processtex
+    manifest = open(os.path.join(args.outdir, 'manifest.jsonl'), 'a')
+
+    # Identical fonts (same program and same ToUnicode table) are only saved
+    # once; usually the same subset is embedded in many pdf files.
+    saved = set()
     for pdf in args.pdfs:
         print("Adding ToUnicode tables to PDF file {}".format(pdf))
         with open(pdf, 'rb') as fobj:
@@ -117,16 +133,31 @@ def main():
                 continue
             print("Adding ToUnicode table to font {}".format(fontname))
             font = fontforge.open('{}({})'.format(pdf, fontname))
+            # If every glyph has a standard name, then the codepoints only
+            # depend on the glyph, so different subsets of the same font can
+            # be merged.
+            standard_names = all(name in GLYPHS for name in font)
+            cmap = generate_tounicode(font, fonts[fontname])
             fonts[fontname].ToUnicode = PdfDict()
-            fonts[fontname].ToUnicode.stream = generate_tounicode(
-                font, fonts[fontname])
-            # Need to save the modified font because fontforge won't read
-            # ToUnicode when it converts to woff later.
-            font.fontname = 'pretex{:06d}'.format(fontnum)
-            font.save(os.path.join(
-                args.outdir, '[{}]{}.sfd'.format(
-                    os.path.basename(pdf)[:-4], fontname)))
-            fontnum += 1
+            fonts[fontname].ToUnicode.stream = cmap
+            program = font_program(fonts[fontname])
+            if program is None:
+                # Can't tell whether it's a duplicate
+                program = '{}({})'.format(pdf, fontname)
+            font_hash = md5(program + cmap).hexdigest()
+            sfd = font_hash + '.sfd'
+            if font_hash not in saved:
+                # Need to save the modified font because fontforge won't read
+                # ToUnicode when it converts to woff later.
+                font.fontname = 'pretex' + font_hash[:12]
+                font.save(os.path.join(args.outdir, sfd))
+                saved.add(font_hash)
+            manifest.write(json.dumps({
+                'sfd'            : sfd,
+                'pdf'            : os.path.basename(pdf)[:-4],
+                'font'           : fontname,
+                'standard_names' : standard_names,
+            }) + '\n')
         PdfWriter(pdf, trailer=doc).write()
 
         # Measure extents for displayed equations
@@ -157,6 +188,7 @@ def main():
                 x, y, w, h = surf.ink_extents()
                 fobj.write(line.strip() + '{},{},{},{}\n'
                            .format(x, y, w, h))
+    manifest.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,98 @@
+#!env python3
+
+# Watches directories for new or modified html files, for pretex.py --watch.
+#
+# Uses inotify (with the inotify_simple package) when it is available, and
+# otherwise compares the sizes and modification times of the files every few
+# seconds.  Either way, a changed file is only reported once its size and
+# modification time have stopped changing for a while, so that files that are
+# still being written are not processed.
+
+import os
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+def signature(path):
+    "Size and modification time of a file, or None if it doesn't exist."
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class Watcher:
+    """
+    Reports html files in 'dirs' that were created or modified.  Changes are
+    looked for every 'interval' seconds when polling, and a file is reported
+    when it hasn't changed for 'settle' seconds.
+    """
+    def __init__(self, dirs, interval=2, settle=1, use_inotify=True):
+        self.dirs = [path for path in dirs if os.path.isdir(path)]
+        self.interval = interval
+        self.settle = settle
+        # Changed files by path: (signature, time it was last seen changing)
+        self.pending = {}
+        self.inotify = None
+        if INotify is not None and use_inotify:
+            self.inotify = INotify()
+            self.watches = {}
+            for path in self.dirs:
+                wd = self.inotify.add_watch(
+                    path, flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE
+                    | flags.MOVED_TO)
+                self.watches[wd] = path
+        else:
+            self.snapshot = self._scan()
+
+    def _scan(self):
+        return {path : signature(path) for path in self._html_files()}
+
+    def _html_files(self):
+        for dirpath in self.dirs:
+            for fname in os.listdir(dirpath):
+                if fname.endswith('.html'):
+                    yield os.path.join(dirpath, fname)
+
+    def _changed(self, timeout):
+        "Wait up to 'timeout' seconds for changes; return the changed files."
+        if self.inotify is not None:
+            return set(os.path.join(self.watches[event.wd], event.name)
+                       for event in self.inotify.read(
+                           timeout=int(timeout * 1000))
+                       if event.name.endswith('.html'))
+        time.sleep(timeout)
+        snapshot = self._scan()
+        changed = set(path for path, sig in snapshot.items()
+                      if self.snapshot.get(path) != sig)
+        self.snapshot = snapshot
+        return changed
+
+    def wait(self):
+        "Wait until some files changed and are complete; return their paths."
+        while True:
+            timeout = self.interval
+            if self.pending:
+                timeout = min(timeout, self.settle / 2)
+            changed = self._changed(timeout)
+            now = time.time()
+            for path in changed:
+                self.pending[path] = (signature(path), now)
+            ready = []
+            for path, (sig, since) in list(self.pending.items()):
+                current = signature(path)
+                if current is None:
+                    # Deleted, or renamed away
+                    del self.pending[path]
+                elif current != sig:
+                    self.pending[path] = (current, now)
+                elif now - since >= self.settle:
+                    del self.pending[path]
+                    ready.append(path)
+            if ready:
+                return sorted(ready)
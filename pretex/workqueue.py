@@ -0,0 +1,363 @@
+#!env python3
+
+# Work queue in a shared directory, for builds on several machines.
+#
+# With --queue DIR, pretex.py puts each chunk of html files in DIR/pending
+# instead of running it in its local pool, and waits for the results.
+# Workers, started with "workqueue.py DIR" on any machine that sees DIR, the
+# build directory and the cache directory at the same paths, claim a chunk by
+# renaming it to DIR/claimed, run processtex on it, and write the result to
+# DIR/done.  Renames within a directory tree are atomic, so a chunk is only
+# claimed once.
+#
+# A worker touches the files of the chunks it is working on every few
+# seconds.  If a worker dies, its chunks stop being touched, and pretex.py
+# puts them back in DIR/pending after --lease seconds.  The times are those of
+# the file server, so the clocks of the machines don't matter: touching a file
+# sets its time to the server's, and pretex.py compares with a file it
+# touched.  A chunk put back while its worker was only slow can run twice; the
+# second result is removed when the build is over.
+#
+# When a chunk fails and pretex.py isn't run with --keep-going, it cancels the
+# build: it removes the pending chunks of the build and creates
+# DIR/cancelled/<build>, and workers stop the chunks of the build they are
+# working on when they next touch them.  pretex.py also cancels the rest of a
+# build when it is over.  The marker is removed once no chunk of the build is
+# pending or claimed; expired chunks of cancelled builds are dropped.
+#
+# A worker that is stopped stops the chunks it is working on, and puts them
+# back in DIR/pending for the other workers.
+
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+import stats
+
+
+PROCESSTEX = os.path.join(os.path.dirname(__file__), 'processtex.py')
+
+# Name of this worker in results
+WORKER = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def unblock_signals():
+    "Undo the signals blocked by the caller, in a child process."
+    signal.pthread_sigmask(signal.SIG_SETMASK, set())
+
+def run_processtex(cmdline, htmls, on_done, on_start=None):
+    """
+    Run processtex on some html files and wait for it.  on_done is called
+    with the number of equations and the name of each finished file, and
+    on_start with the process once it started.  processtex runs in a new
+    process group, so that it can be stopped with the tools it runs by
+    stop().  Returns the process.
+    """
+    # processtex writes a line for each finished file to the pipe
+    progress_r, progress_w = os.pipe()
+    cmdline = cmdline + ['--progress-fd', str(progress_w)]
+    proc = stats.Popen(cmdline + htmls, pass_fds=(progress_w,),
+                       start_new_session=True, preexec_fn=unblock_signals)
+    os.close(progress_w)
+    if on_start is not None:
+        on_start(proc)
+    with os.fdopen(progress_r) as fobj:
+        for line in fobj:
+            equations, html_file = line.rstrip('\n').split(' ', 1)
+            on_done(int(equations), html_file)
+    proc.wait()
+    return proc
+
+def stop(pid):
+    "Stop a processtex started by run_processtex(), and the tools it runs."
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def build_of(name):
+    "The build of a unit, named <build>-<number> by pretex.py."
+    return name.rsplit('-', 1)[0]
+
+
+class WorkQueue:
+    "Work units, stored as json files in a shared directory."
+
+    def __init__(self, path):
+        self.path = path
+        for name in ('pending', 'claimed', 'done', 'tmp', 'cancelled'):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+
+    def _file(self, state, name):
+        return os.path.join(self.path, state, name + '.json')
+
+    def _write(self, state, name, data):
+        "Write a file atomically."
+        tmp_file = os.path.join(self.path, 'tmp', '{}-{}'.format(
+            WORKER.replace(':', '-'), name))
+        with open(tmp_file, 'w') as fobj:
+            json.dump(data, fobj)
+        os.rename(tmp_file, self._file(state, name))
+
+    def put(self, name, unit):
+        self._write('pending', name, unit)
+
+    def claim(self):
+        "Claim a pending unit; returns (name, unit), or None."
+        for fname in sorted(os.listdir(os.path.join(self.path, 'pending'))):
+            name = fname[:-len('.json')]
+            try:
+                # Touched first, so that it isn't seen as claimed long ago
+                os.utime(self._file('pending', name))
+                os.rename(self._file('pending', name),
+                          self._file('claimed', name))
+            except FileNotFoundError:
+                # Claimed by someone else
+                continue
+            with open(self._file('claimed', name)) as fobj:
+                return name, json.load(fobj)
+        return None
+
+    def heartbeat(self, name):
+        try:
+            os.utime(self._file('claimed', name))
+        except FileNotFoundError:
+            # Given to another worker; finish anyway
+            pass
+
+    def finish(self, name, build, result):
+        """
+        Write the result of a claimed unit, unless its build was cancelled,
+        and drop the unit.  It stays claimed until then, so that the marker
+        of a cancelled build stays until the result is discarded.
+        """
+        if not self.cancelled(build):
+            self._write('done', name, result)
+            if self.cancelled(build):
+                # Closed while writing; see close()
+                self.discard(name)
+        self.drop(name)
+        self.prune_cancelled(build)
+
+    def release(self, name):
+        "Put a claimed unit back for another worker."
+        try:
+            os.rename(self._file('claimed', name), self._file('pending', name))
+        except FileNotFoundError:
+            pass
+
+    def drop(self, name):
+        "Forget a claimed unit."
+        try:
+            os.remove(self._file('claimed', name))
+        except FileNotFoundError:
+            pass
+
+    def now(self):
+        "The current time of the file server."
+        fname = os.path.join(self.path, 'tmp', 'clock-{}'.format(
+            WORKER.replace(':', '-')))
+        with open(fname, 'w'):
+            pass
+        now = os.path.getmtime(fname)
+        os.remove(fname)
+        return now
+
+    def requeue_expired(self, lease):
+        "Put units back that haven't had a heartbeat for 'lease' seconds."
+        requeued = []
+        now = self.now()
+        claimed_dir = os.path.join(self.path, 'claimed')
+        for fname in os.listdir(claimed_dir):
+            name = fname[:-len('.json')]
+            build = build_of(name)
+            try:
+                age = now - os.path.getmtime(self._file('claimed', name))
+                if age <= lease:
+                    continue
+                if self.cancelled(build):
+                    os.remove(self._file('claimed', name))
+                    self.prune_cancelled(build)
+                else:
+                    os.rename(self._file('claimed', name),
+                              self._file('pending', name))
+                    requeued.append(name)
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def cancel(self, build):
+        "Cancel the units of a build (see pretex.py), pending or running."
+        with open(os.path.join(self.path, 'cancelled', build), 'w'):
+            pass
+        pending_dir = os.path.join(self.path, 'pending')
+        for fname in os.listdir(pending_dir):
+            if fname.startswith(build + '-'):
+                try:
+                    os.remove(os.path.join(pending_dir, fname))
+                except FileNotFoundError:
+                    continue
+
+    def cancelled(self, build):
+        return os.path.exists(os.path.join(self.path, 'cancelled', build))
+
+    def prune_cancelled(self, build):
+        "Remove the marker of a cancelled build that has no units left."
+        prefix = build + '-'
+        for state in ('pending', 'claimed'):
+            if any(fname.startswith(prefix) for fname
+                   in os.listdir(os.path.join(self.path, state))):
+                return
+        try:
+            os.remove(os.path.join(self.path, 'cancelled', build))
+        except FileNotFoundError:
+            pass
+
+    def close(self, build):
+        """
+        End a build: cancel its remaining units, and remove results that
+        nobody will read.  Workers remove results they write after this.
+        """
+        self.cancel(build)
+        done_dir = os.path.join(self.path, 'done')
+        for fname in os.listdir(done_dir):
+            if fname.startswith(build + '-'):
+                self.discard(fname[:-len('.json')])
+        self.prune_cancelled(build)
+
+    def discard(self, name):
+        "Remove the result of a unit."
+        try:
+            os.remove(self._file('done', name))
+        except FileNotFoundError:
+            pass
+
+    def result(self, name):
+        "The result of a unit and remove it, or None if it isn't done."
+        try:
+            with open(self._file('done', name)) as fobj:
+                result = json.load(fobj)
+        except FileNotFoundError:
+            return None
+        os.remove(self._file('done', name))
+        return result
+
+
+def work(queue, name, unit, heartbeat, running):
+    """
+    Run processtex on a claimed unit; returns its result.  The process is in
+    'running' by pid while it runs.
+    """
+    finished = threading.Event()
+    procs = []
+    def on_start(proc):
+        procs.append(proc)
+        running[proc.pid] = name
+    def beat():
+        while not finished.wait(heartbeat):
+            queue.heartbeat(name)
+            if procs and queue.cancelled(unit['build']):
+                stop(procs[0].pid)
+    threading.Thread(target=beat, daemon=True).start()
+    done = []
+    try:
+        proc = run_processtex(['python3', PROCESSTEX] + unit['argv'],
+                              unit['htmls'],
+                              lambda *entry: done.append(entry),
+                              on_start)
+        status, message = proc.returncode, proc.describe_exit()
+    except OSError as exc:
+        status, message = 1, str(exc)
+    finally:
+        finished.set()
+        if procs:
+            running.pop(procs[0].pid, None)
+    return {
+        'status' : status,
+        'exit'   : message,
+        'worker' : WORKER,
+        'pid'    : procs[0].pid if procs else None,
+        'done'   : done,
+    }
+
+def worker_loop(queue, args):
+    idle_since = time.time()
+    while not args.stopping.is_set():
+        claimed = queue.claim()
+        if claimed is None:
+            if args.idle_exit and time.time() - idle_since > args.idle_exit:
+                return
+            time.sleep(args.poll)
+            continue
+        name, unit = claimed
+        if queue.cancelled(unit['build']):
+            # Put back by requeue_expired() while the build was cancelled
+            queue.drop(name)
+            queue.prune_cancelled(unit['build'])
+            continue
+        if '--ff-workers' not in unit['argv']:
+            # Share the cpus between the chunks run at once
+            unit['argv'] += ['--ff-workers',
+                             str(max((os.cpu_count() or 1) // args.jobs, 1))]
+        if '--scratch-share' not in unit['argv']:
+            # ... and /dev/shm
+            unit['argv'] += ['--scratch-share', str(args.jobs)]
+        print("[{}] Processing {} ({} files)".format(
+            WORKER, name, len(unit['htmls'])), flush=True)
+        result = work(queue, name, unit, args.heartbeat, args.running)
+        if args.stopping.is_set():
+            # Stopped by main(), which gives the unit back
+            return
+        # Nobody waits for the results of cancelled builds
+        queue.finish(name, unit['build'], result)
+        idle_since = time.time()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Process chunks from a pretex.py --queue directory.')
+    parser.add_argument('--jobs', type=int,
+                        default=max((os.cpu_count() or 1) - 1, 1),
+                        help='Number of chunks to process at once')
+    parser.add_argument('--heartbeat', type=float, default=10,
+                        help='Seconds between touching claimed chunks')
+    parser.add_argument('--poll', type=float, default=1,
+                        help='Seconds between looking for pending chunks')
+    parser.add_argument('--idle-exit', type=float, default=0,
+                        help='Exit after this many seconds without work '
+                        '(default: never)')
+    parser.add_argument('queue', type=str,
+                        help='Queue directory')
+    args = parser.parse_args()
+
+    # Stop the running chunks when stopped
+    signal.signal(signal.SIGTERM, lambda signum, _: sys.exit(128 + signum))
+    queue = WorkQueue(args.queue)
+    # Units being processed by the pid of their processtex
+    args.running = {}
+    args.stopping = threading.Event()
+    threads = [threading.Thread(target=worker_loop, args=(queue, args),
+                                daemon=True)
+               for _ in range(args.jobs)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # processtex runs in its own process group, so it doesn't get the
+        # SIGINT of the terminal
+        args.stopping.set()
+        for pid, name in list(args.running.items()):
+            stop(pid)
+            queue.release(name)
+
+if __name__ == '__main__':
+    main()